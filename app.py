@@ -1,21 +1,31 @@
-from flask import Flask, request, redirect, url_for, render_template, send_file, session, flash, jsonify
-from datetime import datetime, timedelta
+from flask import Flask, request, redirect, url_for, render_template, send_file, session, flash, jsonify, make_response
+from datetime import datetime, date, timedelta
 import smtplib
+from email.message import EmailMessage
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+from email.mime.base import MIMEBase
+from email import encoders
+import mimetypes
 import os
+import re
+import time
+import hashlib
 import logging
 import pandas as pd
+import openpyxl
+import xlsxwriter
 import io
 import base64
 from threading import Timer
 from dotenv import load_dotenv
 from supabase import create_client
+from supabase.client import ClientOptions
 import webbrowser
 from apscheduler.schedulers.background import BackgroundScheduler
 import atexit
-from functools import wraps
-from openpyxl.styles import Alignment
+from functools import lru_cache, wraps
+from concurrent.futures import ThreadPoolExecutor
 from werkzeug.security import generate_password_hash, check_password_hash
 import tempfile
 
@@ -24,6 +34,15 @@ MIN_EMAIL_DELAY_HOURS = 24
 # --------Load Environment Variables-------
 load_dotenv()
 
+# PBKDF2 work factor for stored passwords - tunable via env so slower hosts
+# can trade hash strength against login latency without a code change
+PBKDF2_ITER = int(os.getenv('PBKDF2_ITER', '260000'))
+
+
+def hash_pw(password):
+    """Hash a password with the configured PBKDF2 work factor"""
+    return generate_password_hash(password, method=f'pbkdf2:sha256:{PBKDF2_ITER}')
+
 # --------Configure Logging---------
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -34,7 +53,14 @@ scheduler = None
 logger.info("Scheduler initialization deferred - will be set up after Flask app creation")
 
 # --------Initialize Supabase-------
-supabase = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY"))
+# One module-level client for the whole process: supabase-py keeps a
+# persistent httpx session underneath, so every .table(...).execute() reuses
+# the same TLS connection. The explicit timeouts replace the 120s httpx
+# default so a hung PostgREST call cannot pin a worker for two minutes.
+supabase = create_client(
+    os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY"),
+    options=ClientOptions(postgrest_client_timeout=10, storage_client_timeout=10)
+)
 
 # --------Initialize Flask App-------
 app = Flask(__name__)
@@ -132,6 +158,24 @@ def login_required(f):
     return decorated_function
 
 
+def admin_required(f):
+    """Reject non-admin users before the route body runs.
+
+    Stacked under @login_required so logged-out users still get the login
+    redirect; GET requests bounce to the index page, everything else gets
+    a JSON 403 that frontend fetch() calls can report.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not session.get('is_admin'):
+            if request.method == 'GET':
+                return redirect(url_for('index'))
+            return {'error': 'Unauthorized'}, 403
+        return f(*args, **kwargs)
+
+    return decorated_function
+
+
 @app.route('/logout')
 def logout():
     session.clear()
@@ -139,6 +183,57 @@ def logout():
 
 
 # --- Helper Functions ---
+# Explicit column lists for the hot-path clientes queries - PostgREST serializes
+# every selected column to JSON, so only ask for what each route actually reads
+_LIST_COLS = ("adicionado_por,nome,num_mergulho,email,data_mergulho,valor_fatura,"
+              "desconto,iva,nacionalidade,gastos,receita,"
+              "primeiro_email_enviado,segundo_email_enviado,email_manual_enviado")
+_SEND_COLS = "email,nome,nacionalidade,email_manual_enviado"
+
+# Short-TTL cache for the full clientes listing shared by index,
+# atualizar_tabela and exportar_emails; every write path calls
+# _invalidate_clientes_cache() so the next read refetches immediately
+_CLIENTES_CACHE = {'t': 0.0, 'data': None}
+_CLIENTES_TTL = 5.0
+
+
+def get_clientes(max_age=_CLIENTES_TTL):
+    """Full clientes listing (the _LIST_COLS columns), cached for a few seconds.
+
+    formatted_date is attached here so the display conversion runs once per
+    cache fill instead of once per request in every route that renders it.
+    """
+    now = time.monotonic()
+    if _CLIENTES_CACHE['data'] is not None and now - _CLIENTES_CACHE['t'] < max_age:
+        return _CLIENTES_CACHE['data']
+    data = supabase.table("clientes").select(_LIST_COLS).execute().data
+    for cliente in data:
+        s = cliente['data_mergulho']
+        if isinstance(s, str):
+            # Supabase always returns ISO-8601 YYYY-MM-DD; slicing skips strptime entirely
+            cliente['formatted_date'] = f"{s[8:10]}/{s[5:7]}/{s[0:4]}"
+        else:
+            cliente['formatted_date'] = s.strftime('%d/%m/%Y')
+    _CLIENTES_CACHE['data'] = data
+    _CLIENTES_CACHE['t'] = now
+    return data
+
+
+def _invalidate_clientes_cache():
+    _CLIENTES_CACHE['t'] = 0.0
+    _CLIENTES_CACHE['data'] = None
+
+
+def _chunked(records, size=500):
+    """Yield fixed-size slices of a list of rows.
+
+    Bulk inserts/upserts go out in batches so one huge upload can never
+    blow past the PostgREST body limit or run into statement_timeout.
+    """
+    for i in range(0, len(records), size):
+        yield records[i:i + size]
+
+
 def fetch_all_marketing_emails_paginated(list_name=None):
     """
     Fetch all marketing email records using pagination to overcome Supabase's 1000 row default limit.
@@ -171,45 +266,158 @@ def fetch_all_marketing_emails_paginated(list_name=None):
             break
             
         offset += page_size
-    
+
     return all_records
 
 
+# Short-TTL cache for the grouped marketing lists: four routes repeat the
+# same fetch + group-by-list_name, so the aggregation runs at most once per
+# TTL window and every write to marketing_email_lists invalidates it
+_EMAIL_LISTS_CACHE = {'t': 0.0, 'data': None}
+_EMAIL_LISTS_TTL = 30.0
+
+
+def _load_email_lists(max_age=_EMAIL_LISTS_TTL):
+    """Marketing lists grouped for the frontend, cached for a short window"""
+    now = time.monotonic()
+    if _EMAIL_LISTS_CACHE['data'] is not None and now - _EMAIL_LISTS_CACHE['t'] < max_age:
+        return _EMAIL_LISTS_CACHE['data']
+
+    all_records = fetch_all_marketing_emails_paginated()
+
+    lists = {}
+    for record in all_records:
+        lists.setdefault(record['list_name'], []).append(record['email'])
+
+    email_lists = [{'list_name': list_name,
+                    'email_count': len(emails),
+                    'emails': emails}
+                   for list_name, emails in lists.items()]
+
+    _EMAIL_LISTS_CACHE['data'] = email_lists
+    _EMAIL_LISTS_CACHE['t'] = now
+    return email_lists
+
+
+def _invalidate_email_lists_cache():
+    _EMAIL_LISTS_CACHE['t'] = 0.0
+    _EMAIL_LISTS_CACHE['data'] = None
+
+
 # --- Email Functions ---
-def get_email_template_content(nacionalidade, template_type='primeiro'):
-    """Get email template content from database or fallback to default templates"""
+# Map each nationality to its on-disk email template (shared by every template path)
+TEMPLATE_FILES = {
+    'português': 'email_feedback.html',
+    'inglês': 'email_feedback_internacional_ingles.html',
+    'alemão': 'email_feedback_internacional_alemao.html',
+    'francês': 'email_feedback_internacional_frances.html',
+    'dinamarques': 'email_feedback_internacional_dinamarques.html',
+    'espanhol': 'email_feedback_internacional_espanhol.html',
+    'noruegues': 'email_feedback_internacional_noruegues.html',
+    'polaco': 'email_feedback_internacional_polaco.html',
+    'sueco': 'email_feedback_internacional_sueco.html',
+    'outro': 'email_feedback_internacional_ingles.html',  # Use English template for "Other"
+}
+
+# Every nationality the template editors iterate over (same keys as above)
+NACIONALIDADES = tuple(TEMPLATE_FILES)
+
+# Editor page marks every template as file-backed; constant, so built once
+DEFAULT_TEMPLATE_STATUS = dict.fromkeys(NACIONALIDADES, 'default')
+
+
+def _template_mtime(template_file):
+    """Modification time of a template file; part of the cache key so edits
+    on disk are picked up without restarting the app."""
     try:
-        # Always try files first, then check for custom database templates
-        template_files = {
-            'português': 'email_feedback.html',
-            'inglês': 'email_feedback_internacional_ingles.html',
-            'alemão': 'email_feedback_internacional_alemao.html',
-            'francês': 'email_feedback_internacional_frances.html',
-            'dinamarques': 'email_feedback_internacional_dinamarques.html',
-            'espanhol': 'email_feedback_internacional_espanhol.html',
-            'noruegues': 'email_feedback_internacional_noruegues.html',
-            'polaco': 'email_feedback_internacional_polaco.html',
-            'sueco': 'email_feedback_internacional_sueco.html',
-            'outro': 'email_feedback_internacional_ingles.html',  # Use English template for "Other"
-        }
+        return os.path.getmtime(os.path.join(app.root_path, app.template_folder, template_file))
+    except OSError:
+        return 0.0
 
-        template_file = template_files.get(nacionalidade, 'email_feedback.html')
 
-        with app.app_context():
-            file_content = render_template(template_file, nome="[NOME]")
+@lru_cache(maxsize=32)
+def _render_file_template_cached(template_file, mtime):
+    # mtime is only here to key the cache. The email templates reference no
+    # request or app context (no url_for/session/config), so they render
+    # straight through the Jinja environment - no context push, and Flask's
+    # context processors and render signals are skipped. This also lets the
+    # scheduler thread render without faking an app context.
+    return app.jinja_env.get_template(template_file).render(nome="[NOME]")
 
-        # Check if there's a custom template in database
-        try:
-            response = supabase.table("email_templates").select("*").eq("nacionalidade", nacionalidade).eq("tipo",
-                                                                                                           template_type).execute()
 
-            if response.data and response.data[0]['conteudo'].strip():
-                return response.data[0]['conteudo']
-            else:
-                return file_content
-        except Exception as db_error:
-            logger.error(f"Database error, using file template: {str(db_error)}")
-            return file_content
+def _render_file_template(nacionalidade):
+    """Render (and memoize) the on-disk template for a nationality.
+
+    Rendering is cached keyed by (file, mtime), so Jinja only re-runs when
+    the file actually changes; string .replace('[NOME]', nome) is all the
+    per-recipient work that remains.
+    """
+    template_file = TEMPLATE_FILES.get(nacionalidade, 'email_feedback.html')
+    return _render_file_template_cached(template_file, _template_mtime(template_file))
+
+
+@lru_cache(maxsize=32)
+def _file_template_body_cached(template_file, mtime):
+    """Memoized <body> fragment of a file template (what the editor shows)"""
+    full_template = _render_file_template_cached(template_file, mtime)
+    # The HTML comes from our own templates, so two case-insensitive find()
+    # calls and a slice do the job without a regex engine
+    lowered = full_template.lower()
+    start = lowered.find('<body')
+    end = lowered.rfind('</body>')
+    if start != -1 and end != -1:
+        start = full_template.find('>', start) + 1
+        return full_template[start:end].strip()
+    # Fallback to full template if no body tag found
+    return full_template
+
+
+def _file_template_body(nacionalidade):
+    """Body fragment for a nationality, keyed by (file, mtime) so edits on
+    disk are picked up with just a stat() + cache lookup on later requests."""
+    template_file = TEMPLATE_FILES.get(nacionalidade, 'email_feedback.html')
+    return _file_template_body_cached(template_file, _template_mtime(template_file))
+
+
+# In-memory copy of the email_templates table, keyed by (nacionalidade, tipo).
+# Short TTL like the clientes/email-lists caches: a template save reloads
+# the worker that handled it immediately, and the expiry bounds how long
+# the other gunicorn workers (and the scheduler) can send a stale template.
+_TEMPLATE_CACHE = {'t': 0.0, 'data': None}
+_TEMPLATE_TTL = 30.0
+
+
+def _load_template_cache():
+    """(Re)load all custom templates from the database in a single query"""
+    try:
+        response = supabase.table("email_templates").select("nacionalidade,tipo,conteudo").execute()
+        cache = {}
+        for row in (response.data or []):
+            if row.get('conteudo') and row['conteudo'].strip():
+                cache[(row['nacionalidade'], row['tipo'])] = row['conteudo']
+        _TEMPLATE_CACHE['data'] = cache
+        _TEMPLATE_CACHE['t'] = time.monotonic()
+        logger.info(f"Loaded {len(cache)} custom email templates into cache")
+    except Exception as e:
+        logger.error(f"Error loading template cache: {str(e)}")
+
+
+def _get_custom_template(nacionalidade, template_type):
+    """Cached lookup of a custom template; None when only the file default exists"""
+    if _TEMPLATE_CACHE['data'] is None or time.monotonic() - _TEMPLATE_CACHE['t'] >= _TEMPLATE_TTL:
+        _load_template_cache()
+    templates = _TEMPLATE_CACHE['data'] or {}
+    return templates.get((nacionalidade, template_type))
+
+
+def get_email_template_content(nacionalidade, template_type='primeiro'):
+    """Get email template content from database or fallback to default templates"""
+    try:
+        # Custom database template wins; otherwise fall back to the file default
+        custom_content = _get_custom_template(nacionalidade, template_type)
+        if custom_content:
+            return custom_content
+        return _render_file_template(nacionalidade)
 
     except Exception as e:
         logger.error(f"Error getting template content: {str(e)}")
@@ -217,25 +425,64 @@ def get_email_template_content(nacionalidade, template_type='primeiro'):
         return f"<p>Olá [NOME],</p><p>Obrigado pela sua experiência de mergulho!</p><p>Atenciosamente,<br>Atlantic Diving Center</p>"
 
 
-def enviar_email(destinatario, assunto, nome, internacional, template_type='primeiro'):
+def build_email_message(destinatario, assunto, nome, internacional, template_type='primeiro'):
+    """Build the feedback email message without sending it"""
+    # Get template content (custom or default)
+    template_content = get_email_template_content(internacional, template_type)
+
+    # Replace [NOME] placeholder with actual name
+    corpo_html = template_content.replace('[NOME]', nome)
+
+    # Create message
+    msg = MIMEMultipart("alternative")
+    msg['From'] = app.config['SMTP_USERNAME']
+    msg['To'] = destinatario
+    msg['Subject'] = assunto
+    msg.attach(MIMEText(corpo_html, "html"))
+    return msg
+
+
+def open_smtp_connection():
+    """Open and authenticate a single SMTP_SSL connection (caller owns the lifecycle)"""
+    server = smtplib.SMTP_SSL(app.config['SMTP_SERVER'], app.config['SMTP_PORT'])
+    server.login(app.config['SMTP_USERNAME'], app.config['SMTP_PASSWORD'])
+    return server
+
+
+def ensure_smtp_connection(server):
+    """NOOP health check on a batch connection; reconnect if the server dropped it"""
+    if server is None:
+        return open_smtp_connection()
     try:
-        # Get template content (custom or default)
-        template_content = get_email_template_content(internacional, template_type)
+        server.noop()
+        return server
+    except smtplib.SMTPServerDisconnected:
+        logger.warning("SMTP connection dropped mid-batch, reconnecting")
+        return open_smtp_connection()
 
-        # Replace [NOME] placeholder with actual name
-        corpo_html = template_content.replace('[NOME]', nome)
 
-        # Create message
-        msg = MIMEMultipart("alternative")
-        msg['From'] = app.config['SMTP_USERNAME']
-        msg['To'] = destinatario
-        msg['Subject'] = assunto
-        msg.attach(MIMEText(corpo_html, "html"))
+def close_smtp_connection(server):
+    """Close a batch connection, ignoring servers that already hung up"""
+    if server is None:
+        return
+    try:
+        server.quit()
+    except Exception:
+        pass
+
+
+def enviar_email(destinatario, assunto, nome, internacional, template_type='primeiro', server=None):
+    try:
+        msg = build_email_message(destinatario, assunto, nome, internacional, template_type)
 
-        # Use SMTP settings from environment variables
-        with smtplib.SMTP_SSL(app.config['SMTP_SERVER'], app.config['SMTP_PORT']) as server:
-            server.login(app.config['SMTP_USERNAME'], app.config['SMTP_PASSWORD'])
+        if server is not None:
+            # Reuse the already-authenticated batch connection
             server.send_message(msg)
+        else:
+            # One-off send: open a connection just for this message
+            with smtplib.SMTP_SSL(app.config['SMTP_SERVER'], app.config['SMTP_PORT']) as own_server:
+                own_server.login(app.config['SMTP_USERNAME'], app.config['SMTP_PASSWORD'])
+                own_server.send_message(msg)
 
         logger.info(
             f"EMAIL SENT: {destinatario} | Subject: {assunto} | Template: {template_type} | From: {app.config['SMTP_USERNAME']} | Time: {datetime.now()}")
@@ -244,19 +491,29 @@ def enviar_email(destinatario, assunto, nome, internacional, template_type='prim
         logger.error(f"Email failed: {str(e)}")
         return False
 
-def email_feedback(cliente, template_type='primeiro'):
-    assunto = {
-        'inglês': "Thank you for your diving experience!",
-        'francês': "Merci d'avoir plongé avec nous",
-        'alemão': "Danke für Ihr Taucherlebnis",
-        'dinamarques': "Tak for din dykkeroplevelse!",
-        'espanhol': "¡Gracias por tu experiencia de buceo!",
-        'noruegues': "Takk for din dykkeopplevelse!",
-        'polaco': "Dziękujemy za Twoje doświadczenie nurkowe!",
-        'sueco': "Tack för din dykupplevelse!",
-        'outro': "Thank you for your diving experience!",  # Use English subject for "Other"
-    }.get(cliente['nacionalidade'], "Obrigado pela sua experiência de mergulho!")
-    return enviar_email(cliente['email'], assunto, cliente['nome'], cliente['nacionalidade'], template_type)
+# Feedback subject per nationality, built once at import instead of per send
+_SUBJECTS = {
+    'inglês': "Thank you for your diving experience!",
+    'francês': "Merci d'avoir plongé avec nous",
+    'alemão': "Danke für Ihr Taucherlebnis",
+    'dinamarques': "Tak for din dykkeroplevelse!",
+    'espanhol': "¡Gracias por tu experiencia de buceo!",
+    'noruegues': "Takk for din dykkeopplevelse!",
+    'polaco': "Dziękujemy za Twoje doświadczenie nurkowe!",
+    'sueco': "Tack för din dykupplevelse!",
+    'outro': "Thank you for your diving experience!",  # Use English subject for "Other"
+}
+_DEFAULT_SUBJECT = "Obrigado pela sua experiência de mergulho!"
+
+
+def _feedback_subject(nacionalidade):
+    return _SUBJECTS.get(nacionalidade, _DEFAULT_SUBJECT)
+
+
+def email_feedback(cliente, template_type='primeiro', server=None):
+    assunto = _feedback_subject(cliente['nacionalidade'])
+    return enviar_email(cliente['email'], assunto, cliente['nome'], cliente['nacionalidade'], template_type,
+                        server=server)
 
 
 def check_and_send_emails():
@@ -268,36 +525,70 @@ def check_and_send_emails():
             logger.info(f"Current time: {hoje}")
             logger.info(f"MIN_EMAIL_DELAY_HOURS: {MIN_EMAIL_DELAY_HOURS}")
 
-            response = supabase.table("clientes").select("*").execute()
+            # Single filtered query: only rows that can still need an email
+            # (flags false and dive at least one day old) instead of SELECT * + N re-fetches.
+            # An inequality (not an exact today-1 match) is required because the second
+            # email is keyed off the first email's timestamp, not the dive date.
+            corte = (hoje.date() - timedelta(days=1)).isoformat()
+
+            # Cheap existence probe first: in steady state nobody is pending,
+            # so most ticks end here instead of fetching the working set
+            pending = supabase.table("clientes").select(
+                "email", count="exact"
+            ).or_(
+                "primeiro_email_enviado.eq.false,segundo_email_enviado.eq.false"
+            ).lte("data_mergulho", corte).limit(1).execute()
+            if not pending.data:
+                logger.info("No clients with pending emails - nothing to do")
+                return
+
+            response = supabase.table("clientes").select(
+                "email,nome,nacionalidade,data_mergulho,"
+                "primeiro_email_enviado,segundo_email_enviado,primeiro_email_enviado_em"
+            ).or_(
+                "primeiro_email_enviado.eq.false,segundo_email_enviado.eq.false"
+            ).lte("data_mergulho", corte).execute()
             clientes = response.data
             logger.info(f"Checking emails for {len(clientes)} clients")
 
+            # One SMTP connection for the whole batch (opened lazily on first send)
+            server = None
+            send_attempts = 0
+            send_failures = 0
+
+            # Successful sends are flushed as one bulk update per flag after the loop
+            primeiro_ok = []
+            segundo_ok = []
+
             for cliente in clientes:
+                # Abort the batch if more than a third of the sends failed
+                # (likely rate-limited or misconfigured - no point hammering the server)
+                if send_attempts >= 3 and send_failures * 3 > send_attempts:
+                    logger.error(
+                        f"ABORTING BATCH: {send_failures}/{send_attempts} sends failed - will retry on next run")
+                    break
+
                 try:
                     logger.info(f"\n--- Processing client: {cliente['email']} ---")
                     logger.info(f"Client data: {cliente}")
-
-                    data_mergulho = datetime.strptime(cliente['data_mergulho'], '%Y-%m-%d').date()
-                    dias_passados = (hoje.date() - data_mergulho).days
-
-                    logger.info(f"Dive date: {data_mergulho}")
-                    logger.info(f"Days passed: {dias_passados}")
+                    logger.info(f"Dive date: {cliente['data_mergulho']}")
                     logger.info(f"First email sent: {cliente['primeiro_email_enviado']}")
                     logger.info(f"Second email sent: {cliente['segundo_email_enviado']}")
                     logger.info(f"First email timestamp: {cliente.get('primeiro_email_enviado_em')}")
 
-                    # First email logic (1+ days after dive)
-                    if dias_passados >= 1 and not cliente['primeiro_email_enviado']:
+                    # First email logic - the lte(data_mergulho, corte) filter
+                    # already guarantees the dive is 1+ days old, so no date
+                    # parsing is needed here
+                    if not cliente['primeiro_email_enviado']:
                         logger.info(f"ATTEMPTING: First email to {cliente['email']}")
 
-                        if email_feedback(cliente, 'primeiro'):
-                            # Store when the first email was sent
-                            supabase.table("clientes").update({
-                                "primeiro_email_enviado": True,
-                                "primeiro_email_enviado_em": hoje.isoformat()
-                            }).eq("email", cliente['email']).execute()
+                        server = ensure_smtp_connection(server)
+                        send_attempts += 1
+                        if email_feedback(cliente, 'primeiro', server=server):
+                            primeiro_ok.append(cliente['email'])
                             logger.info(f"SUCCESS: First email sent to {cliente['email']}")
                         else:
+                            send_failures += 1
                             logger.error(f"FAILED: First email to {cliente['email']}")
 
                     # Second email logic - detailed debugging
@@ -324,13 +615,13 @@ def check_and_send_emails():
                                 if hours_since_first_email >= MIN_EMAIL_DELAY_HOURS:
                                     logger.info(
                                         f"ATTEMPTING: Second email to {cliente['email']} ({hours_since_first_email:.2f} hours after first)")
-                                    if email_feedback(cliente, 'segundo'):
-                                        supabase.table("clientes").update({
-                                            "segundo_email_enviado": True,
-                                            "segundo_email_enviado_em": hoje.isoformat()
-                                        }).eq("email", cliente['email']).execute()
+                                    server = ensure_smtp_connection(server)
+                                    send_attempts += 1
+                                    if email_feedback(cliente, 'segundo', server=server):
+                                        segundo_ok.append(cliente['email'])
                                         logger.info(f"SUCCESS: Second email sent to {cliente['email']}")
                                     else:
+                                        send_failures += 1
                                         logger.error(f"FAILED: Second email to {cliente['email']}")
                                 else:
                                     logger.info(
@@ -346,6 +637,23 @@ def check_and_send_emails():
                     logger.error(f"Error processing client {cliente.get('email', 'unknown')}: {str(client_error)}")
                     continue
 
+            close_smtp_connection(server)
+
+            # Flush the status flags in one round trip per flag instead of one per client;
+            # the flag condition still makes the update the guard against double-sends
+            if primeiro_ok:
+                supabase.table("clientes").update({
+                    "primeiro_email_enviado": True,
+                    "primeiro_email_enviado_em": hoje.isoformat()
+                }).in_("email", primeiro_ok).eq("primeiro_email_enviado", False).execute()
+            if segundo_ok:
+                supabase.table("clientes").update({
+                    "segundo_email_enviado": True,
+                    "segundo_email_enviado_em": hoje.isoformat()
+                }).in_("email", segundo_ok).eq("segundo_email_enviado", False).execute()
+            if primeiro_ok or segundo_ok:
+                _invalidate_clientes_cache()
+
             logger.info(f"=== EMAIL CHECK COMPLETED ===\n")
 
     except Exception as e:
@@ -355,11 +663,9 @@ def check_and_send_emails():
 # Also add this test route to manually trigger email checking:
 @app.route('/test-emails')
 @login_required
+@admin_required
 def test_emails():
     """Manual trigger for email checking (for testing)"""
-    if not session.get('is_admin'):
-        return 'Unauthorized', 403
-
     logger.info("Manual email check triggered")
     check_and_send_emails()
     return "Email check completed. Check logs for details."
@@ -368,18 +674,18 @@ def test_emails():
 # Add this route to check a specific client's status:
 @app.route('/debug-client/<email>')
 @login_required
+@admin_required
 def debug_client_detailed(email):
     """Detailed debug info for a specific client"""
-    if not session.get('is_admin'):
-        return 'Unauthorized', 403
-
     try:
-        response = supabase.table("clientes").select("*").eq("email", email).execute()
+        response = supabase.table("clientes").select(
+            "email,nome,data_mergulho,primeiro_email_enviado,segundo_email_enviado,primeiro_email_enviado_em"
+        ).eq("email", email).execute()
         if not response.data:
             return {'error': 'Cliente não encontrado'}, 404
 
         cliente = response.data[0]
-        data_mergulho = datetime.strptime(cliente["data_mergulho"], "%Y-%m-%d").date()
+        data_mergulho = date.fromisoformat(cliente["data_mergulho"])
         hoje = datetime.now()
         dias_passados = (hoje.date() - data_mergulho).days
 
@@ -415,56 +721,47 @@ def debug_client_detailed(email):
 # Only add scheduler job if scheduler exists and not in debug mode
 if scheduler is not None:
     try:
-        # Remove any existing email check jobs to prevent duplicates
-        existing_jobs = scheduler.get_jobs()
-        for job in existing_jobs:
-            if job.id == 'email_check_job':
-                scheduler.remove_job('email_check_job')
-                logger.info("Removed existing email check job")
-
-        # Add the job
+        # replace_existing=True atomically swaps any previous job with this id,
+        # so no get_jobs()/remove_job dance is needed
         scheduler.add_job(
             check_and_send_emails,
             'interval',
-            minutes=1,
+            minutes=15,
             timezone="Europe/Lisbon",
             id='email_check_job',
             replace_existing=True,
             max_instances=1,
-            coalesce=True
+            coalesce=True,
+            misfire_grace_time=300
         )
         logger.info("Email check job added to scheduler")
     except Exception as e:
         logger.error(f"Error setting up email scheduler: {str(e)}")
-        # Only add job if it doesn't already exist
-        try:
-            scheduler.add_job(
-                check_and_send_emails,
-                'interval',
-                minutes=1,
-                timezone="Europe/Lisbon",
-                id='email_check_job',
-                replace_existing=True,
-                max_instances=1,
-                coalesce=True
-            )
-            logger.info("Email check job added to scheduler (fallback)")
-        except Exception as fallback_error:
-            logger.error(f"Failed to add email check job in fallback: {str(fallback_error)}")
 else:
     logger.info("Skipping email scheduler - scheduler not available")
 
 
+@app.route('/admin/reload-templates', methods=['POST'])
+@login_required
+@admin_required
+def reload_templates():
+    """Clear the in-memory template cache (after changing template files on disk)"""
+    _render_file_template_cached.cache_clear()
+    _file_template_body_cached.cache_clear()
+    flash('Templates recarregados a partir dos ficheiros.', 'success')
+    logger.info("File template cache cleared")
+    return redirect(url_for('index'))
+
+
 @app.route('/clear-email-templates', methods=['POST'])
 @login_required
+@admin_required
 def clear_email_templates():
     """Clear all email templates from database (for testing)"""
-    if not session.get('is_admin'):
-        return 'Unauthorized', 403
-
     try:
         # Delete all email templates
         supabase.table("email_templates").delete().neq("id", 0).execute()
+        _load_template_cache()
         flash('Todos os templates de email foram removidos da base de dados.', 'success')
         logger.info("All email templates cleared from database")
     except Exception as e:
@@ -483,77 +780,94 @@ def index():
         email = request.form['email']
         logger.info(f"Registration attempt for email: {email}")
 
-        existing_client = supabase.table("clientes").select("*").eq("email", email).execute()
-        if existing_client.data:
-            mensagem = f"Email {email} already registered"
-        else:
-            desconto_str = request.form.get('desconto', '')
+        desconto_str = request.form.get('desconto', '')
+        try:
+            desconto = float(desconto_str)
+        except (ValueError, TypeError):
+            desconto = 0.0
+
+        # Handle gastos field (admin only)
+        gastos = 0.0
+        if session.get('is_admin'):
+            gastos_str = request.form.get('gastos', '')
             try:
-                desconto = float(desconto_str)
+                gastos = float(gastos_str) if gastos_str else 0.0
             except (ValueError, TypeError):
-                desconto = 0.0
-
-            # Handle gastos field (admin only)
-            gastos = 0.0
-            if session.get('is_admin'):
-                gastos_str = request.form.get('gastos', '')
-                try:
-                    gastos = float(gastos_str) if gastos_str else 0.0
-                except (ValueError, TypeError):
-                    gastos = 0.0
+                gastos = 0.0
 
-            # Parse core numeric fields safely
-            try:
-                valor_fatura = float(request.form['valor_fatura'])
-            except (ValueError, TypeError, KeyError):
-                valor_fatura = 0.0
+        # Parse core numeric fields safely
+        try:
+            valor_fatura = float(request.form['valor_fatura'])
+        except (ValueError, TypeError, KeyError):
+            valor_fatura = 0.0
 
-            try:
-                iva_value = float(request.form.get('iva', 22)) / 100
-            except (ValueError, TypeError):
-                iva_value = 0.22
-
-            # Compute receita on the server for all users (avoids missing field for non-admin)
-            receita_value = valor_fatura - gastos
-
-            supabase.table("clientes").insert({
-                "adicionado_por": session.get('username', 'desconhecido'),
-                "nome": request.form['nome'],
-                "num_mergulho": int(request.form['num_mergulho']),
-                "email": email,
-                "data_mergulho": request.form['data_mergulho'],
-                "valor_fatura": valor_fatura,
-                "desconto": desconto,
-                "iva": iva_value,
-                "nacionalidade": request.form.get('nacionalidade', 'português'),
-                "gastos": gastos,
-                "primeiro_email_enviado": False,
-                "segundo_email_enviado": False,
-                "email_manual_enviado": False,
-                "receita": receita_value
+        try:
+            iva_value = float(request.form.get('iva', 22)) / 100
+        except (ValueError, TypeError):
+            iva_value = 0.22
+
+        # Compute receita on the server for all users (avoids missing field for non-admin)
+        receita_value = valor_fatura - gastos
+
+        # One atomic upsert instead of a select + insert pair: the unique
+        # index on email (migrations/clientes_email_unique.sql) rejects
+        # duplicates and ignore_duplicates makes the call return no rows
+        # instead of raising, so the duplicate message comes from res.data.
+        res = supabase.table("clientes").upsert({
+            "adicionado_por": session.get('username', 'desconhecido'),
+            "nome": request.form['nome'],
+            "num_mergulho": int(request.form['num_mergulho']),
+            "email": email,
+            "data_mergulho": request.form['data_mergulho'],
+            "valor_fatura": valor_fatura,
+            "desconto": desconto,
+            "iva": iva_value,
+            "nacionalidade": request.form.get('nacionalidade', 'português'),
+            "gastos": gastos,
+            "primeiro_email_enviado": False,
+            "segundo_email_enviado": False,
+            "email_manual_enviado": False,
+            "receita": receita_value
 
-            }).execute()
+        }, on_conflict="email", ignore_duplicates=True).execute()
+        if not res.data:
+            mensagem = f"Email {email} already registered"
+        else:
+            _invalidate_clientes_cache()
             return redirect(url_for('index'))
 
-    clientes = supabase.table("clientes").select("*").execute().data
-    for cliente in clientes:
-        if isinstance(cliente['data_mergulho'], str):
-            cliente['formatted_date'] = datetime.strptime(
-                cliente['data_mergulho'],
-                '%Y-%m-%d'
-            ).strftime('%d/%m/%Y')
-        else:
-            cliente['formatted_date'] = cliente['data_mergulho'].strftime('%d/%m/%Y')
+    clientes = get_clientes()
 
     return render_template("formulario_clientes.html", clientes=clientes, mensagem=mensagem)
 
 
 # --------Send Email Manually---------
+# Pool shared by the manual-send routes so the SMTP handshake never runs
+# inside a Flask request
+_mail_pool = ThreadPoolExecutor(max_workers=4)
+atexit.register(_mail_pool.shutdown)
+
+
+def _send_and_mark(cliente):
+    """Send the feedback email and flip the flag, off the request thread."""
+    try:
+        if email_feedback(cliente, 'primeiro'):
+            supabase.table("clientes").update({"email_manual_enviado": True}) \
+                .eq("email", cliente['email']).execute()
+            _invalidate_clientes_cache()
+            logger.info(f'MANUAL: Email enviado com sucesso para {cliente["email"]}!')
+        else:
+            logger.error(f'MANUAL: Falha ao enviar email para {cliente["email"]}')
+    except Exception as e:
+        logger.error(f'MANUAL: Erro ao enviar para {cliente["email"]}: {str(e)}')
+
+
 @app.route('/enviar/<email>', methods=['POST'])
+@login_required
 def enviar_manual(email):
     try:
         # Fetch client from Supabase
-        response = supabase.table("clientes").select("*").eq("email", email).execute()
+        response = supabase.table("clientes").select(_SEND_COLS).eq("email", email).execute()
         if not response.data:
             return 'Cliente não encontrado', 404
 
@@ -566,18 +880,10 @@ def enviar_manual(email):
                 return 'Email já enviado', 400
             return redirect(url_for('index'))
 
-        logger.info(f'MANUAL: Sending email to {email}')
-        if email_feedback(cliente, 'primeiro'):
-            # Update in Supabase
-            supabase.table("clientes").update({"email_manual_enviado": True}).eq("email", email).execute()
-
-            if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-                return '', 204
-            logger.info('MANUAL: Email enviado com sucesso!')
-        else:
-            if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-                return 'Falha ao enviar email', 400
-            logger.info('MANUAL: Falha ao enviar email')
+        # Hand the TLS handshake + login + send to the pool so the response
+        # only waits on Supabase; failures are logged from the worker
+        logger.info(f'MANUAL: Queueing email to {email}')
+        _mail_pool.submit(_send_and_mark, cliente)
 
     except Exception as e:
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
@@ -593,7 +899,7 @@ def enviar_manual(email):
 @app.route('/get-email-template/<email>')
 def get_email_template(email):
     try:
-        response = supabase.table("clientes").select("*").eq("email", email).execute()
+        response = supabase.table("clientes").select("nome,nacionalidade").eq("email", email).execute()
         if not response.data:
             return {'error': 'Cliente não encontrado'}, 404
 
@@ -612,53 +918,77 @@ def get_email_template(email):
 
 # --------Send Custom Email---------
 @app.route('/enviar-email-personalizado', methods=['POST'])
+@login_required
 def enviar_email_personalizado():
     try:
         email = request.form.get('email')
         subject = request.form.get('subject')
         content = request.form.get('content')
 
-        # Get file attachments
-        attachments = []
+        # Read the attachments into plain tuples on the request thread -
+        # FileStorage streams die with the request, bytes do not
+        attachment_blobs = []
         for key in request.files:
             if key.startswith('attachment_'):
                 file = request.files[key]
                 if file and file.filename:
-                    attachments.append(file)
+                    attachment_blobs.append((file.filename, file.mimetype, file.read()))
 
         # Fetch client from Supabase
-        response = supabase.table("clientes").select("*").eq("email", email).execute()
+        response = supabase.table("clientes").select("email,email_manual_enviado").eq("email", email).execute()
         if not response.data:
             return 'Cliente não encontrado', 404
 
         cliente = response.data[0]
 
-        # Check if email was already sent
+        # Check if email was already sent (kept on the request thread so
+        # duplicate clicks still fail fast)
         if cliente['email_manual_enviado']:
             logger.info(f'Email já enviado para {email}')
             return 'Email já enviado', 400
 
-        # Send the custom email with attachments
-        if enviar_email_personalizado_aux(cliente['email'], subject, content, attachments):
-            # Update in Supabase
-            supabase.table("clientes").update({"email_manual_enviado": True}).eq("email", email).execute()
-            logger.info(f'Email personalizado enviado com sucesso para {email} com {len(attachments)} anexos')
-            return '', 204
-        else:
-            logger.error(f'Falha ao enviar email personalizado para {email}')
-            return 'Falha ao enviar email', 400
+        # Hand the SMTP work to the pool and answer immediately
+        _mail_pool.submit(_send_personalizado_and_mark, cliente['email'], subject, content, attachment_blobs)
+        return '', 204
 
     except Exception as e:
         logger.error(f'Erro ao enviar email personalizado: {str(e)}')
         return str(e), 500
 
 
-def enviar_email_personalizado_aux(destinatario, assunto, conteudo, attachments=None):
+def _send_personalizado_and_mark(email, subject, content, attachment_blobs):
+    """Send the custom email and flip the flag, off the request thread."""
     try:
-        from email.mime.multipart import MIMEMultipart
-        from email.mime.text import MIMEText
-        from email.mime.image import MIMEImage
+        if enviar_email_personalizado_aux(email, subject, content, attachment_blobs):
+            supabase.table("clientes").update({"email_manual_enviado": True}).eq("email", email).execute()
+            _invalidate_clientes_cache()
+            logger.info(f'Email personalizado enviado com sucesso para {email} com {len(attachment_blobs)} anexos')
+        else:
+            logger.error(f'Falha ao enviar email personalizado para {email}')
+    except Exception as e:
+        logger.error(f'Erro ao enviar email personalizado para {email}: {str(e)}')
+
+
+def _build_attachment(filename, file_data, mimetype=None):
+    """MIME part for one attachment with its real content type.
 
+    Everything used to be wrapped as image/jpeg, which corrupted PDFs and
+    documents in most mail clients; the type now comes from the upload's
+    own mimetype or, failing that, the filename extension.
+    """
+    ctype = mimetype or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    maintype, subtype = ctype.split('/', 1)
+    part = MIMEBase(maintype, subtype)
+    part.set_payload(file_data)
+    encoders.encode_base64(part)
+    part.add_header('Content-Disposition', 'attachment', filename=filename)
+    return part
+
+
+def enviar_email_personalizado_aux(destinatario, assunto, conteudo, attachment_blobs=None, server=None):
+    """Build and send a custom HTML email; attachment_blobs is a list of
+    (filename, mimetype, bytes) tuples so callers can hand work across threads."""
+    try:
         # Create multipart message
         msg = MIMEMultipart("mixed")
         msg['From'] = app.config['SMTP_USERNAME']
@@ -673,32 +1003,23 @@ def enviar_email_personalizado_aux(destinatario, assunto, conteudo, attachments=
         msg.attach(html_part)
 
         # Attach all files
-        if attachments:
-            for attachment in attachments:
+        if attachment_blobs:
+            for filename, mimetype, file_data in attachment_blobs:
                 try:
-                    # Read file data
-                    file_data = attachment.read()
-
-                    # Create MIME attachment
-                    mime_attachment = MIMEImage(file_data, _subtype='jpeg')  # Default to jpeg
-                    mime_attachment.add_header('Content-Disposition', 'attachment', filename=attachment.filename)
-
-                    # Attach to message
-                    msg.attach(mime_attachment)
-
-                    # Reset file pointer for potential future reads
-                    attachment.seek(0)
-
+                    msg.attach(_build_attachment(filename, file_data, mimetype))
                 except Exception as attach_error:
-                    logger.error(f"Error attaching file {attachment.filename}: {str(attach_error)}")
+                    logger.error(f"Error attaching file {filename}: {str(attach_error)}")
 
-        # Send email using SMTP settings from environment variables
-        with smtplib.SMTP_SSL(app.config['SMTP_SERVER'], app.config['SMTP_PORT']) as server:
-            server.login(app.config['SMTP_USERNAME'], app.config['SMTP_PASSWORD'])
+        # Send email - reuse the caller's batch connection when given one
+        if server is not None:
             server.send_message(msg)
+        else:
+            with smtplib.SMTP_SSL(app.config['SMTP_SERVER'], app.config['SMTP_PORT']) as own_server:
+                own_server.login(app.config['SMTP_USERNAME'], app.config['SMTP_PASSWORD'])
+                own_server.send_message(msg)
 
         logger.info(
-            f"Custom email sent successfully to {destinatario} with {len(attachments) if attachments else 0} attachments from {app.config['SMTP_USERNAME']}")
+            f"Custom email sent successfully to {destinatario} with {len(attachment_blobs) if attachment_blobs else 0} attachments from {app.config['SMTP_USERNAME']}")
         return True
 
     except Exception as e:
@@ -708,10 +1029,12 @@ def enviar_email_personalizado_aux(destinatario, assunto, conteudo, attachments=
 
 # ---------Remover---------
 @app.route('/remover/<email>', methods=['POST'])
+@login_required
 def remover_cliente(email):
     try:
         # Delete from Supabase
         supabase.table("clientes").delete().eq("email", email).execute()
+        _invalidate_clientes_cache()
         return '', 204  # Successful deletion returns no content
     except Exception as e:
         return str(e), 500
@@ -720,11 +1043,9 @@ def remover_cliente(email):
 # ---------Update Gastos---------
 @app.route('/update-gastos', methods=['POST'])
 @login_required
+@admin_required
 def update_gastos():
     """Update gastos and receita for a client (admin only)"""
-    if not session.get('is_admin'):
-        return {'success': False, 'error': 'Unauthorized'}, 403
-
     try:
         data = request.get_json()
         email = data.get('email')
@@ -733,21 +1054,16 @@ def update_gastos():
         if not email:
             return {'success': False, 'error': 'Email is required'}
 
-        # Buscar valor_final atual do cliente
-        resultado = supabase.table("clientes").select("valor_fatura").eq("email", email).execute()
-        dados = resultado.data
+        # One round-trip: the update_gastos SQL function
+        # (migrations/update_gastos_function.sql) sets gastos and recomputes
+        # receita where the row lives, returning the new receita
+        resultado = supabase.rpc('update_gastos', {'p_email': email, 'p_gastos': gastos}).execute()
+        receita = resultado.data
 
-        if not dados:
+        if receita is None:
             return {'success': False, 'error': 'Cliente não encontrado'}
 
-        valor_fatura = dados[0]["valor_fatura"]
-        receita = valor_fatura - gastos
-
-        # Atualizar gastos e receita
-        supabase.table("clientes").update({
-            "gastos": gastos,
-            "receita": receita
-        }).eq("email", email).execute()
+        _invalidate_clientes_cache()
 
         logger.info(f"Gastos e receita atualizados para {email}: gastos={gastos}, receita={receita}")
         return {'success': True}
@@ -759,28 +1075,79 @@ def update_gastos():
 
 
 # -------Send Email to All-----------
+def _send_manual_chunk(chunk):
+    """Send one worker's slice of the manual batch over its own SMTP connection.
+
+    Each item is (cliente, assunto, template_content); returns the list of
+    addresses sent plus the attempt/failure counts for the batch abort check.
+    """
+    ok = []
+    attempts = 0
+    failures = 0
+    server = None
+    smtp_user = app.config['SMTP_USERNAME']  # hoisted out of the send loop
+    try:
+        for cliente, assunto, template_content in chunk:
+            # Abort the slice if more than a third of the sends failed
+            # (likely rate-limited or misconfigured - no point hammering the server)
+            if attempts >= 3 and failures * 3 > attempts:
+                logger.error(f'ABORTANDO: {failures}/{attempts} envios falharam')
+                break
+
+            try:
+                server = ensure_smtp_connection(server)
+                attempts += 1
+
+                # Minimal per-recipient envelope instead of a fresh MIMEMultipart
+                msg = EmailMessage()
+                msg['From'] = smtp_user
+                msg['To'] = cliente['email']
+                msg['Subject'] = assunto
+                msg.set_content(template_content.replace('[NOME]', cliente['nome']), subtype='html')
+                server.send_message(msg)
+
+                ok.append(cliente["email"])
+                logger.info(f'Email enviado com sucesso para {cliente["email"]}')
+            except Exception as send_error:
+                failures += 1
+                logger.error(f'Falha ao enviar email para {cliente["email"]}: {str(send_error)}')
+    finally:
+        close_smtp_connection(server)
+    return ok, attempts, failures
+
+
 @app.route('/enviar-todos', methods=['POST'])
+@login_required
 def enviar_manual_todos():
     try:
         # Fetch all clients from Supabase
-        response = supabase.table("clientes").select("*").execute()
+        response = supabase.table("clientes").select(_SEND_COLS).execute()
         clientes = response.data
 
-        emails_sent = 0
-        for cliente in clientes:
-            # Only send if manual email hasn't been sent yet
-            if not cliente['email_manual_enviado']:
-                if email_feedback(cliente, 'primeiro'):
-                    supabase.table("clientes").update({"email_manual_enviado": True}).eq("email",
-                                                                                         cliente["email"]).execute()
-                    logger.info(f'Email enviado com sucesso para {cliente["email"]}')
-                    emails_sent += 1
-                else:
-                    logger.error(f'Falha ao enviar email para {cliente["email"]}')
-            else:
-                logger.info(f'Email já enviado para {cliente["email"]}, pulando...')
-
-        logger.info(f'Emails enviados para {emails_sent} clientes')
+        # Only send if manual email hasn't been sent yet
+        pendentes = [c for c in clientes if not c['email_manual_enviado']]
+        ja_enviados = len(clientes) - len(pendentes)
+        if ja_enviados:
+            logger.info(f'Email já enviado para {ja_enviados} clientes, pulando...')
+
+        # Group by nationality: the subject and template body are resolved once per
+        # group and only the To/[NOME] pair changes per recipient
+        por_nacionalidade = {}
+        for cliente in pendentes:
+            por_nacionalidade.setdefault(cliente['nacionalidade'], []).append(cliente)
+
+        trabalho = []
+        for nacionalidade, grupo in por_nacionalidade.items():
+            assunto = _feedback_subject(nacionalidade)
+            template_content = get_email_template_content(nacionalidade, 'primeiro')
+            for cliente in grupo:
+                trabalho.append((cliente, assunto, template_content))
+
+        # The batch runs entirely off the request thread; the browser gets
+        # its redirect as soon as the work list is built
+        if trabalho:
+            _mail_pool.submit(_enviar_todos_background, trabalho)
+            logger.info(f'Envio em massa agendado para {len(trabalho)} clientes')
         return redirect(url_for('index'))
 
     except Exception as e:
@@ -788,15 +1155,46 @@ def enviar_manual_todos():
         return redirect(url_for('index'))
 
 
+def _enviar_todos_background(trabalho):
+    """Fan the manual batch out over workers and flush the flags, off-request."""
+    try:
+        # Sends are independent, so fan them out over a small worker pool;
+        # each worker keeps one persistent SMTP connection for its slice
+        ok_emails = []
+        send_attempts = 0
+        send_failures = 0
+        n_workers = min(4, len(trabalho))
+        chunks = [trabalho[i::n_workers] for i in range(n_workers)]
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            for ok, attempts, failures in pool.map(_send_manual_chunk, chunks):
+                ok_emails.extend(ok)
+                send_attempts += attempts
+                send_failures += failures
+
+        # Mark every successful send in a single bulk update. A single PATCH with
+        # an in_() filter is preferred over upsert(on_conflict="email") here:
+        # upsert would insert skeleton rows for any address missing from the
+        # table, while PATCH only ever touches existing rows.
+        if ok_emails:
+            supabase.table("clientes").update({"email_manual_enviado": True}).in_("email", ok_emails).execute()
+            _invalidate_clientes_cache()
+
+        logger.info(f'Emails enviados para {len(ok_emails)} clientes')
+    except Exception as e:
+        logger.error(f'Erro no envio em massa: {str(e)}')
+
+
 # --------Debug----------
 @app.route('/debug/<email>')
 def debug_cliente(email):
-    response = supabase.table("clientes").select("*").eq("email", email).execute()
+    response = supabase.table("clientes").select(
+        "nome,data_mergulho,primeiro_email_enviado,segundo_email_enviado,email_manual_enviado"
+    ).eq("email", email).execute()
     if not response.data:
         return 'Cliente não encontrado', 404
 
     cliente = response.data[0]
-    data_mergulho = datetime.strptime(cliente["data_mergulho"], "%Y-%m-%d").date()
+    data_mergulho = date.fromisoformat(cliente["data_mergulho"])
 
     return {
         'nome': cliente["nome"],
@@ -809,78 +1207,114 @@ def debug_cliente(email):
 
 
 # --------Table Refreshing------------
+# Last rendered clientes table, keyed by the ETag of the underlying rows
+_TABELA_CACHE = {'etag': None, 'html': None}
+
+
 @app.route('/atualizar-tabela')
 def atualizar_tabela():
-    clientes = supabase.table("clientes").select("*").execute().data
-    for cliente in clientes:
-        if isinstance(cliente['data_mergulho'], str):
-            cliente['formatted_date'] = datetime.strptime(
-                cliente['data_mergulho'],
-                '%Y-%m-%d'
-            ).strftime('%d/%m/%Y')
-        else:
-            cliente['formatted_date'] = cliente['data_mergulho'].strftime('%d/%m/%Y')
-    return render_template("partials/tabela_clientes.html", clientes=clientes)
+    clientes = get_clientes()
+
+    # Hash the raw rows: when nothing changed the poll costs a 304 instead
+    # of a full re-render + transfer of the whole table
+    etag = hashlib.md5(repr(clientes).encode('utf-8')).hexdigest()
+    if request.headers.get('If-None-Match') == etag:
+        return '', 304
+
+    if _TABELA_CACHE['etag'] == etag:
+        html = _TABELA_CACHE['html']
+    else:
+        html = render_template("partials/tabela_clientes.html", clientes=clientes)
+        _TABELA_CACHE['etag'] = etag
+        _TABELA_CACHE['html'] = html
+
+    response = make_response(html)
+    response.headers['ETag'] = etag
+    return response
 
 
 # --------Send Email to All------------
 @app.route('/exportar-emails')
 def exportar_emails():
     try:
-        response = supabase.table("clientes").select("*").execute()
-        clientes = response.data
-        clientes_data = [{
-            'Adicionado por': cliente["adicionado_por"],
-            'Nome': cliente["nome"],
-            'Email': cliente["email"],
-            'Nº Mergulhos': cliente["num_mergulho"],
-            'Data Mergulho': datetime.strptime(cliente["data_mergulho"], "%Y-%m-%d").strftime('%Y/%m/%d'),
-            'Nacionalidade': cliente["nacionalidade"].capitalize(),
-            '1º Email Enviado': 'Sim' if cliente["primeiro_email_enviado"] else 'Não',
-            '2º Email Enviado': 'Sim' if cliente["segundo_email_enviado"] else 'Não',
-            'Email Manual': 'Sim' if cliente["email_manual_enviado"] else 'Não',
-            'Desconto (%)': cliente["desconto"],
-            'Valor(€)': cliente["valor_fatura"],
-            'Valor com Iva(€)': cliente["valor_fatura"] * (1 + cliente["iva"]),
-            'Valor de IVA(€)': cliente["valor_fatura"] * cliente["iva"],
-            'Gastos(€)': cliente.get("gastos", 0) or 0,
-            'Receita(€)': cliente["receita"]
-        } for cliente in clientes]
-
-        df = pd.DataFrame(clientes_data)
+        clientes = get_clientes()
+
+        export_columns = ['Adicionado por', 'Nome', 'Email', 'Nº Mergulhos', 'Data Mergulho',
+                          'Nacionalidade', '1º Email Enviado', '2º Email Enviado', 'Email Manual',
+                          'Desconto (%)', 'Valor(€)', 'Valor com Iva(€)', 'Valor de IVA(€)',
+                          'Gastos(€)', 'Receita(€)']
+
+        if clientes:
+            # Build the sheet with vectorized pandas ops instead of a per-row Python loop
+            base = pd.DataFrame(clientes)
+            sim_nao = {True: 'Sim', False: 'Não'}
+            # One multiply shared by both IVA columns instead of the
+            # (1 + iva) detour that re-does it
+            valor_iva = base['valor_fatura'] * base['iva']
+            df = pd.DataFrame({
+                'Adicionado por': base['adicionado_por'],
+                'Nome': base['nome'],
+                'Email': base['email'],
+                'Nº Mergulhos': base['num_mergulho'],
+                'Data Mergulho': pd.to_datetime(base['data_mergulho'], format='%Y-%m-%d').dt.strftime('%Y/%m/%d'),
+                'Nacionalidade': base['nacionalidade'].str.capitalize(),
+                '1º Email Enviado': base['primeiro_email_enviado'].fillna(False).astype(bool).map(sim_nao),
+                '2º Email Enviado': base['segundo_email_enviado'].fillna(False).astype(bool).map(sim_nao),
+                'Email Manual': base['email_manual_enviado'].fillna(False).astype(bool).map(sim_nao),
+                'Desconto (%)': base['desconto'],
+                'Valor(€)': base['valor_fatura'],
+                'Valor com Iva(€)': base['valor_fatura'] + valor_iva,
+                'Valor de IVA(€)': valor_iva,
+                'Gastos(€)': base['gastos'].fillna(0),
+                'Receita(€)': base['receita']
+            })
+        else:
+            df = pd.DataFrame(columns=export_columns)
+
+        # NULL numeric fields (receita, desconto, ...) come through as NaN,
+        # which write_row refuses; None writes a blank cell like the old
+        # exporter did
+        df = df.astype(object).where(df.notna(), None)
+
         output = io.BytesIO()
 
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False, sheet_name='Clientes')
-            workbook = writer.book
-            worksheet = writer.sheets['Clientes']
-
-            for row in worksheet.iter_rows(min_row=2, min_col=11, max_col=15):
-                for cell in row:
-                    cell.number_format = '#,##0.00" €"'
-            for column in worksheet.columns:
-                max_length = 0
-                column_letter = column[0].column_letter
-                for cell in column:
-                    try:
-                        if len(str(cell.value)) > max_length:
-                            max_length = len(str(cell.value))
-                    except:
-                        pass
-                adjusted_width = (max_length + 5)  # instead of +2
-                worksheet.column_dimensions[column_letter].width = adjusted_width
-
-            # Center all cells
-            for row in worksheet.iter_rows():
-                for cell in row:
-                    cell.alignment = Alignment(horizontal='right', vertical='center')
+        money_cols = {'Valor(€)', 'Valor com Iva(€)', 'Valor de IVA(€)', 'Gastos(€)', 'Receita(€)'}
+
+        # constant_memory streams each row to disk as soon as the next one is
+        # written, so the sheet never sits in memory alongside the DataFrame.
+        # (pandas' to_excel writes column-wise and silently loses data in this
+        # mode, so the rows are written explicitly.)
+        workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+        worksheet = workbook.add_worksheet('Clientes')
+
+        base_fmt = workbook.add_format({'align': 'right', 'valign': 'vcenter'})
+        euro_fmt = workbook.add_format({'num_format': '#,##0.00" €"', 'align': 'right', 'valign': 'vcenter'})
+        header_fmt = workbook.add_format({'bold': True, 'align': 'right', 'valign': 'vcenter'})
+
+        # Widths and formats per column instead of touching every cell;
+        # set_column must run before the rows in constant_memory mode
+        for i, column_name in enumerate(df.columns):
+            max_length = len(column_name)
+            if len(df):
+                # max() is NaN when the column is NULL in every row
+                col_max = df[column_name].astype(str).str.len().max()
+                if pd.notna(col_max):
+                    max_length = max(max_length, int(col_max))
+            worksheet.set_column(i, i, max_length + 5,
+                                 euro_fmt if column_name in money_cols else base_fmt)
+
+        worksheet.write_row(0, 0, df.columns, header_fmt)
+        for row_idx, row in enumerate(df.itertuples(index=False), start=1):
+            worksheet.write_row(row_idx, 0, row)
+        workbook.close()
 
         output.seek(0)
         return send_file(
             output,
             mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
             as_attachment=True,
-            download_name='Clientes_Atlantic_Diving_Center.xlsx'
+            download_name='Clientes_Atlantic_Diving_Center.xlsx',
+            conditional=True  # enables range requests so interrupted downloads can resume
         )
 
     except Exception as e:
@@ -891,11 +1325,9 @@ def exportar_emails():
 # --------------Get emails from excel files--------------
 @app.route('/upload-excel-emails', methods=['POST'])
 @login_required
+@admin_required
 def upload_excel_emails():
     """Upload Excel file and extract emails from a column"""
-    if not session.get('is_admin'):
-        return redirect(url_for('index'))
-
     try:
         if 'excel_file' not in request.files:
             flash('Nenhum arquivo selecionado.', 'danger')
@@ -911,13 +1343,7 @@ def upload_excel_emails():
             return redirect(url_for('marketing_emails'))
 
         # Get sheet name from form
-        sheet_name = request.form.get('sheet_name', '').strip()
-        
-        # Read the Excel file from specific sheet
-        if sheet_name:
-            df = pd.read_excel(file, sheet_name=sheet_name)
-        else:
-            df = pd.read_excel(file)  # Default to first sheet
+        sheet_name = request.form.get('sheet_name', '').strip() or 0
 
         # Get column name from form
         column_name = request.form.get('email_column', '').strip()
@@ -926,18 +1352,21 @@ def upload_excel_emails():
             flash('Por favor, especifique o nome da coluna que contém os emails.', 'danger')
             return redirect(url_for('marketing_emails'))
 
-        # Check if column exists
-        if column_name not in df.columns:
-            available_columns = ', '.join(df.columns.tolist())
+        # Validate the column against a header-only read, then load just that
+        # column - the reader never materializes the unused columns
+        header = pd.read_excel(file, sheet_name=sheet_name, nrows=0)
+        if column_name not in header.columns:
+            available_columns = ', '.join(header.columns.tolist())
             flash(f'Coluna "{column_name}" não encontrada. Colunas disponíveis: {available_columns}', 'danger')
             return redirect(url_for('marketing_emails'))
 
-        # Extract emails from the specified column
-        emails = []
-        for email in df[column_name].dropna():
-            email_str = str(email).strip()
-            if email_str and '@' in email_str:
-                emails.append(email_str)
+        file.seek(0)
+        df = pd.read_excel(file, sheet_name=sheet_name, usecols=[column_name], dtype=str)
+
+        # Extract emails from the specified column in one vectorized pass
+        # instead of a Python loop over every cell
+        s = df[column_name].dropna().astype(str).str.strip()
+        emails = s[(s != '') & s.str.contains('@', regex=False)].tolist()
 
         if not emails:
             flash('Nenhum email válido encontrado na coluna especificada.', 'warning')
@@ -945,8 +1374,7 @@ def upload_excel_emails():
 
         # Save emails to the marketing emails file
         marketing_emails_file = 'marketing_emails.txt'
-        with open(marketing_emails_file, 'w', encoding='utf-8') as f:
-            f.write('\n'.join(emails))
+        _write_marketing_emails(marketing_emails_file, emails)
 
         flash(f'✅ {len(emails)} emails importados com sucesso do arquivo Excel!', 'success')
         logger.info(f"Imported {len(emails)} emails from Excel file: {file.filename}")
@@ -962,11 +1390,9 @@ def upload_excel_emails():
 # ---------View collumns from excel files---------
 @app.route('/preview-excel-sheets', methods=['POST'])
 @login_required
+@admin_required
 def preview_excel_sheets():
     """Preview Excel file sheets"""
-    if not session.get('is_admin'):
-        return {'error': 'Unauthorized'}, 403
-
     try:
         if 'excel_file' not in request.files:
             return {'error': 'Nenhum arquivo selecionado.'}, 400
@@ -1014,11 +1440,9 @@ def preview_excel_sheets():
 
 @app.route('/preview-excel-columns', methods=['POST'])
 @login_required
+@admin_required
 def preview_excel_columns():
     """Preview Excel file columns from a specific sheet"""
-    if not session.get('is_admin'):
-        return {'error': 'Unauthorized'}, 403
-
     try:
         if 'excel_file' not in request.files:
             return {'error': 'Nenhum arquivo selecionado.'}, 400
@@ -1032,28 +1456,37 @@ def preview_excel_columns():
 
         # Get sheet name from request
         sheet_name = request.form.get('sheet_name', None)
-        
-        # Read the Excel file from specific sheet
-        if sheet_name:
-            df = pd.read_excel(file, sheet_name=sheet_name)
-        else:
-            df = pd.read_excel(file)  # Default to first sheet
-
-        # Get column names and first few values
-        columns_info = []
-        for col in df.columns:
-            # Get first 5 non-null values from the column
-            sample_values = df[col].dropna().head(5).tolist()
-            # Convert numpy.int64 to regular Python int for JSON serialization
-            non_null_count = int(df[col].notna().sum())
-            total_rows = int(len(df))
-
-            columns_info.append({
-                'name': col,
-                'sample_values': sample_values,
-                'total_rows': total_rows,
-                'non_null_count': non_null_count
-            })
+
+        # Stream the sheet with openpyxl read_only (same as the upload
+        # route): one pass collects the whole-sheet counts the column
+        # picker displays plus a few sample values per column, without
+        # materializing the sheet in a DataFrame
+        try:
+            workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+            worksheet = workbook[sheet_name] if sheet_name else workbook.active
+        except KeyError:
+            return {'error': f'Aba "{sheet_name}" não encontrada no arquivo.'}, 400
+
+        rows = worksheet.iter_rows(values_only=True)
+        headers = [str(h) if h is not None else '' for h in next(rows, ())]
+        non_null_counts = [0] * len(headers)
+        sample_values = [[] for _ in headers]
+        total_rows = 0
+        for row in rows:
+            total_rows += 1
+            for i, value in enumerate(row[:len(headers)]):
+                if value is not None:
+                    non_null_counts[i] += 1
+                    if len(sample_values[i]) < 5:
+                        sample_values[i].append(value)
+        workbook.close()
+
+        columns_info = [{
+            'name': name,
+            'sample_values': sample_values[i],
+            'total_rows': total_rows,
+            'non_null_count': non_null_counts[i]
+        } for i, name in enumerate(headers)]
 
         return {
             'columns': columns_info,
@@ -1069,10 +1502,8 @@ def preview_excel_columns():
 # ---------Admin managing users-----------
 @app.route('/admin/users', methods=['GET', 'POST'])
 @login_required
+@admin_required
 def manage_users():
-    if not session.get('is_admin'):
-        return redirect(url_for('index'))
-
     # Handle user creation
     if request.method == 'POST' and 'create_user' in request.form:
         logger.info(f"Creating user: {request.form}")
@@ -1083,7 +1514,7 @@ def manage_users():
         try:
             supabase.table("usuarios").insert({
                 "username": username,
-                "password_hash": password,  # Store as plain text
+                "password_hash": hash_pw(password),
                 "is_admin": is_admin
             }).execute()
             flash("Usuário criado com sucesso!", 'success')
@@ -1100,7 +1531,7 @@ def manage_users():
 
         try:
             # Get current user data
-            current_user = supabase.table("usuarios").select("*").eq("id", user_id).execute()
+            current_user = supabase.table("usuarios").select("id").eq("id", user_id).execute()
             if not current_user.data:
                 flash("Utilizador não encontrado!", 'error')
                 return redirect(url_for('manage_users'))
@@ -1113,7 +1544,7 @@ def manage_users():
 
             # Only update password if a new one is provided
             if password.strip():
-                update_data["password_hash"] = password  # Store as plain text
+                update_data["password_hash"] = hash_pw(password)
 
             # Update the user
             supabase.table("usuarios").update(update_data).eq("id", user_id).execute()
@@ -1131,7 +1562,8 @@ def manage_users():
         except Exception as e:
             flash(f"Erro ao remover usuário: {e}", 'error')
 
-    users = supabase.table("usuarios").select("*").execute().data
+    # password_hash stays in the projection because admin_users.html renders it
+    users = supabase.table("usuarios").select("id,username,password_hash,is_admin").execute().data
     return render_template("admin_users.html", users=users)
 
 # ----------Login-------------
@@ -1148,63 +1580,39 @@ def login():
             return render_template('login.html')
 
         try:
-            # Debug logging to see what's happening
-            logger.info(f"=== LOGIN DEBUG ===")
-            logger.info(f"Entered username: '{entered_username}'")
-            logger.info(f"Entered password: '{entered_password}'")
-
-            # First, let's try to get ALL users to see if the connection works
-            all_users = supabase.table("usuarios").select("*").execute()
-            logger.info(f"All users in database: {all_users.data}")
+            user_data = supabase.table("usuarios").select(
+                "id,username,password_hash,is_admin"
+            ).eq("username", entered_username).execute()
 
-            # Now try the specific query
-            user_data = supabase.table("usuarios").select("*").eq("username", entered_username).execute()
-            logger.info(f"Specific user query result: {user_data.data}")
-
-            # Let's also try with different variations
-            user_data_lower = supabase.table("usuarios").select("*").eq("username", entered_username.lower()).execute()
-            logger.info(f"Lowercase username query: {user_data_lower.data}")
-
-            user_data_upper = supabase.table("usuarios").select("*").eq("username", entered_username.upper()).execute()
-            logger.info(f"Uppercase username query: {user_data_upper.data}")
-
-            # Check if we got any results
-            if user_data.data and len(user_data.data) > 0:
+            if user_data.data:
                 user = user_data.data[0]
                 stored_password = user['password_hash']
-                logger.info(f"Found user: {user}")
-                logger.info(f"Stored password: '{stored_password}'")
-
-                if stored_password == entered_password:
-                    session['logged_in'] = True
-                    session['username'] = entered_username
-                    session['is_admin'] = bool(user['is_admin'])
-                    logger.info(f"Login successful for: {entered_username}")
-                    return redirect(url_for('index'))
-                else:
-                    logger.info(f"Password mismatch. Stored: '{stored_password}', Entered: '{entered_password}'")
 
-            # Try case-insensitive search as fallback
-            elif user_data_lower.data and len(user_data_lower.data) > 0:
-                user = user_data_lower.data[0]
-                stored_password = user['password_hash']
-                logger.info(f"Found user with lowercase search: {user}")
+                try:
+                    password_ok = check_password_hash(stored_password, entered_password)
+                except Exception:
+                    password_ok = False
 
-                if stored_password == entered_password:
+                if not password_ok and stored_password == entered_password:
+                    # Legacy plaintext row: accept once and upgrade it to a hash
+                    password_ok = True
+                    try:
+                        supabase.table("usuarios").update({
+                            "password_hash": hash_pw(entered_password)
+                        }).eq("id", user['id']).execute()
+                        logger.info(f"Upgraded plaintext password to hash for user id {user['id']}")
+                    except Exception as upgrade_error:
+                        logger.error(f"Failed to upgrade password hash: {str(upgrade_error)}")
+
+                if password_ok:
                     session['logged_in'] = True
-                    session['username'] = user['username']  # Use the actual username from DB
+                    session['username'] = user['username']
                     session['is_admin'] = bool(user['is_admin'])
-                    logger.info(f"Login successful (case-insensitive) for: {user['username']}")
+                    logger.info(f"Login successful for: {user['username']}")
                     return redirect(url_for('index'))
 
-            else:
-                logger.info(f"No user found with username: '{entered_username}'")
-
         except Exception as e:
             logger.error(f"Login error: {str(e)}")
-            logger.error(f"Exception type: {type(e)}")
-            import traceback
-            logger.error(f"Full traceback: {traceback.format_exc()}")
             flash(f'Erro no login: {str(e)}', 'danger')
             return render_template('login.html')
 
@@ -1219,7 +1627,8 @@ def test_db():
     """Test route to check database connection"""
     try:
         # Try to get all users
-        result = supabase.table("usuarios").select("*").execute()
+        # Connectivity probe only - never pull password hashes into this response
+        result = supabase.table("usuarios").select("id,username,is_admin").execute()
         return {
             'success': True,
             'data': result.data,
@@ -1242,48 +1651,22 @@ def set_iva():
 
 
 # --------Edit Email Templates---------
-@app.route('/editar-primeiro-email', methods=['GET', 'POST'])
-@login_required
-def editar_primeiro_email():
-    logger.info(f"editar_primeiro_email route called with method: {request.method}")
-    if not session.get('is_admin'):
-        logger.info("User is not admin")
-        return redirect(url_for('index'))
+def _prepare_editing(template_kind):
+    """Shared body of the two template-editor entry routes.
+
+    The routes were identical except for the 'primeiro'/'segundo' marker
+    stored in the session, so the loop and temp-file handoff live here once.
+    """
 
     try:
-        logger.info("Getting template content for primeiro email")
+        logger.info(f"Getting template content for {template_kind} email")
         # Get template content using the same logic as get_email_template_content
         template_content = {}
-        nacionalidades = ['português', 'inglês', 'francês', 'alemão', 'dinamarques', 'espanhol', 'noruegues', 'polaco',
-                          'sueco', 'outro']
-        import re  # Move import to top of function
 
-        for nacionalidade in nacionalidades:
+        for nacionalidade in NACIONALIDADES:
             try:
-                # Always load from file first
-                template_files = {
-                    'português': 'email_feedback.html',
-                    'inglês': 'email_feedback_internacional_ingles.html',
-                    'francês': 'email_feedback_internacional_frances.html',
-                    'alemão': 'email_feedback_internacional_alemao.html',
-                    'dinamarques': 'email_feedback_internacional_dinamarques.html',
-                    'espanhol': 'email_feedback_internacional_espanhol.html',
-                    'noruegues': 'email_feedback_internacional_noruegues.html',
-                    'polaco': 'email_feedback_internacional_polaco.html',
-                    'sueco': 'email_feedback_internacional_sueco.html',
-                    'outro': 'email_feedback_internacional_ingles.html',  # Use English template for "Other"
-                }
-                template_file = template_files.get(nacionalidade, 'email_feedback.html')
-
-                with app.app_context():
-                    full_template = render_template(template_file, nome="[NOME]")
-                    # Extract only the body content for the editor
-                    body_match = re.search(r'<body[^>]*>(.*?)</body>', full_template, re.DOTALL | re.IGNORECASE)
-                    if body_match:
-                        template_content[nacionalidade] = body_match.group(1).strip()
-                    else:
-                        # Fallback to full template if no body tag found
-                        template_content[nacionalidade] = full_template
+                # Memoized render + body extraction
+                template_content[nacionalidade] = _file_template_body(nacionalidade)
                 logger.info(f"Loaded template from file for {nacionalidade}")
 
             except Exception as e:
@@ -1293,10 +1676,9 @@ def editar_primeiro_email():
                     nacionalidade] = f"<p>Olá [NOME],</p><p>Obrigado pela sua experiência de mergulho!</p><p>Atenciosamente,<br>Atlantic Diving Center</p>"
 
         # Store only the template type in session (not the large content)
-        session['editing_template'] = 'primeiro'
+        session['editing_template'] = template_kind
 
         # Store template content in a temporary file instead of session
-        import tempfile
         import json
 
         temp_file = tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.json', encoding='utf-8')
@@ -1311,94 +1693,34 @@ def editar_primeiro_email():
         return redirect(url_for('edit_email_template'))
 
     except Exception as e:
-        logger.error(f"Erro ao editar primeiro email: {str(e)}")
+        logger.error(f"Erro ao editar {template_kind} email: {str(e)}")
         flash('Erro ao abrir editor de email', 'danger')
         return redirect(url_for('index'))
 
 
+@app.route('/editar-primeiro-email', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def editar_primeiro_email():
+    logger.info(f"editar_primeiro_email route called with method: {request.method}")
+    return _prepare_editing('primeiro')
+
+
 # -----------Edit Second Email------------
 @app.route('/editar-segundo-email', methods=['GET', 'POST'])
 @login_required
+@admin_required
 def editar_segundo_email():
     logger.info(f"editar_segundo_email route called with method: {request.method}")
-    if not session.get('is_admin'):
-        logger.info("User is not admin")
-        return redirect(url_for('index'))
-
-    try:
-        logger.info("Getting template content for segundo email")
-        # Get template content using the same logic as get_email_template_content
-        template_content = {}
-        nacionalidades = ['português', 'inglês', 'francês', 'alemão', 'dinamarques', 'espanhol', 'noruegues', 'polaco',
-                          'sueco', 'outro']
-        import re  # Move import to top of function
-
-        for nacionalidade in nacionalidades:
-            try:
-                # Always load from file first
-                template_files = {
-                    'português': 'email_feedback.html',
-                    'inglês': 'email_feedback_internacional_ingles.html',
-                    'francês': 'email_feedback_internacional_frances.html',
-                    'alemão': 'email_feedback_internacional_alemao.html',
-                    'dinamarques': 'email_feedback_internacional_dinamarques.html',
-                    'espanhol': 'email_feedback_internacional_espanhol.html',
-                    'noruegues': 'email_feedback_internacional_noruegues.html',
-                    'polaco': 'email_feedback_internacional_polaco.html',
-                    'sueco': 'email_feedback_internacional_sueco.html',
-                    'outro': 'email_feedback_internacional_ingles.html',  # Use English template for "Other"
-                }
-                template_file = template_files.get(nacionalidade, 'email_feedback.html')
-
-                with app.app_context():
-                    full_template = render_template(template_file, nome="[NOME]")
-                    # Extract only the body content for the editor
-                    body_match = re.search(r'<body[^>]*>(.*?)</body>', full_template, re.DOTALL | re.IGNORECASE)
-                    if body_match:
-                        template_content[nacionalidade] = body_match.group(1).strip()
-                    else:
-                        # Fallback to full template if no body tag found
-                        template_content[nacionalidade] = full_template
-                logger.info(f"Loaded template from file for {nacionalidade}")
-
-            except Exception as e:
-                logger.error(f"Error loading template for {nacionalidade}: {str(e)}")
-                # Fallback template content
-                template_content[
-                    nacionalidade] = f"<p>Olá [NOME],</p><p>Obrigado pela sua experiência de mergulho!</p><p>Atenciosamente,<br>Atlantic Diving Center</p>"
-
-        # Store only the template type in session (not the large content)
-        session['editing_template'] = 'segundo'
-
-        # Store template content in a temporary file instead of session
-        import tempfile
-        import json
-
-        temp_file = tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.json', encoding='utf-8')
-        json.dump(template_content, temp_file)
-        temp_file.close()
-
-        # Store the file path in session (much smaller)
-        session['template_file_path'] = temp_file.name
-
-        logger.info(f"Template content stored in temporary file: {temp_file.name}")
-        logger.info("Redirecting to edit_email_template")
-        return redirect(url_for('edit_email_template'))
-
-    except Exception as e:
-        logger.error(f"Erro ao editar segundo email: {str(e)}")
-        flash('Erro ao abrir editor de email', 'danger')
-        return redirect(url_for('index'))
+    return _prepare_editing('segundo')
 
 
 # -------------Edit templates---------------
 @app.route('/edit-email-template', methods=['GET', 'POST'])
 @login_required
+@admin_required
 def edit_email_template():
     logger.info("edit_email_template route called")
-    if not session.get('is_admin'):
-        logger.info("User is not admin")
-        return redirect(url_for('index'))
 
     if request.method == 'POST':
         try:
@@ -1469,6 +1791,9 @@ def edit_email_template():
                 # User wants to reset to defaults - clear database entries
                 supabase.table("email_templates").delete().eq("tipo", editing_template).execute()
                 flash('Templates resetados para os padrões dos arquivos.', 'success')
+
+            # Keep the in-memory template cache in sync with the table
+            _load_template_cache()
             return redirect(url_for('index'))
 
         except Exception as e:
@@ -1507,69 +1832,25 @@ def edit_email_template():
     # Check for custom templates in database and override file content
     template_content = check_database_templates(template_content, editing_template)
 
-    # All templates are loaded from files, so they're all "default"
-    template_status = {
-        'português': 'default',
-        'inglês': 'default',
-        'francês': 'default',
-        'alemão': 'default',
-        'dinamarques': 'default',
-        'espanhol': 'default',
-        'noruegues': 'default',
-        'polaco': 'default',
-        'sueco': 'default',
-        'outro': 'default',
-    }
-
-    # Debug: Print template content lengths
-    for nacionalidade, content in template_content.items():
-        logger.info(f"Template {nacionalidade}: {len(content)} chars")
-        logger.info(f"First 100 chars: {content[:100]}...")
-        logger.info(f"Last 100 chars: {content[-100:] if len(content) > 100 else content}")
+    # Debug: lazy formatting so the slicing never happens above DEBUG level
+    if logger.isEnabledFor(logging.DEBUG):
+        for nacionalidade, content in template_content.items():
+            logger.debug("Template %s: %d chars, starts %r", nacionalidade, len(content), content[:100])
 
     return render_template('edit_email_template.html',
                            template_content=template_content,
                            editing_template=editing_template,
-                           template_status=template_status)
+                           template_status=DEFAULT_TEMPLATE_STATUS)
 
 
 def load_templates_from_files(editing_template):
     """Load templates from HTML files"""
     template_content = {}
-    nacionalidades = ['português', 'inglês', 'francês', 'alemão', 'dinamarques', 'espanhol', 'noruegues', 'polaco',
-                      'sueco', 'outro']
-    import re
 
-    for nacionalidade in nacionalidades:
+    for nacionalidade in NACIONALIDADES:
         try:
-            # Always load from file first
-            template_files = {
-                'português': 'email_feedback.html',
-                'inglês': 'email_feedback_internacional_ingles.html',
-                'francês': 'email_feedback_internacional_frances.html',
-                'alemão': 'email_feedback_internacional_alemao.html',
-                'dinamarques': 'email_feedback_internacional_dinamarques.html',
-                'espanhol': 'email_feedback_internacional_espanhol.html',
-                'noruegues': 'email_feedback_internacional_noruegues.html',
-                'polaco': 'email_feedback_internacional_polaco.html',
-                'sueco': 'email_feedback_internacional_sueco.html',
-                'outro': 'email_feedback_internacional_ingles.html',  # Use English template for "Other"
-            }
-            template_file = template_files.get(nacionalidade, 'email_feedback.html')
-
-            with app.app_context():
-                full_template = render_template(template_file, nome="[NOME]")
-                # Extract only the body content for the editor
-                body_match = re.search(r'<body[^>]*>(.*?)</body>', full_template, re.DOTALL | re.IGNORECASE)
-                if body_match:
-                    template_content[nacionalidade] = body_match.group(1).strip()
-                    logger.info(
-                        f"Extracted body content for {nacionalidade}: {len(template_content[nacionalidade])} chars")
-                else:
-                    # Fallback to full template if no body tag found
-                    template_content[nacionalidade] = full_template
-                    logger.info(
-                        f"Using full template for {nacionalidade}: {len(template_content[nacionalidade])} chars")
+            # Memoized render + body extraction
+            template_content[nacionalidade] = _file_template_body(nacionalidade)
             logger.info(f"Loaded template from file for {nacionalidade} ({editing_template})")
 
         except Exception as e:
@@ -1582,30 +1863,93 @@ def load_templates_from_files(editing_template):
 
 def check_database_templates(template_content, editing_template):
     """Check for custom templates in database and override file content"""
-    nacionalidades = ['português', 'inglês', 'francês', 'alemão', 'dinamarques', 'espanhol', 'noruegues', 'polaco',
-                      'sueco', 'outro']
 
-    for nacionalidade in nacionalidades:
-        try:
-            response = supabase.table("email_templates").select("*").eq("nacionalidade", nacionalidade).eq("tipo",
-                                                                                                           editing_template).execute()
-            if response.data and response.data[0]['conteudo'].strip():
-                template_content[nacionalidade] = response.data[0]['conteudo']
-                logger.info(f"Loaded custom template from database for {nacionalidade}")
-        except Exception as db_error:
-            logger.error(f"Error loading custom template for {nacionalidade}: {str(db_error)}")
+    # One query for every nationality instead of a round-trip per iteration
+    try:
+        response = supabase.table("email_templates").select("nacionalidade,conteudo") \
+            .eq("tipo", editing_template).in_("nacionalidade", list(NACIONALIDADES)).execute()
+        for row in response.data:
+            if row['conteudo'].strip():
+                template_content[row['nacionalidade']] = row['conteudo']
+                logger.info(f"Loaded custom template from database for {row['nacionalidade']}")
+    except Exception as db_error:
+        logger.error(f"Error loading custom templates: {str(db_error)}")
 
     return template_content
 
 
 # --------------Marketing emails functions---------------
+def _send_marketing_chunk(emails, subject, content, attachment_blobs):
+    """Send one worker's slice of a marketing batch over its own SMTP connection.
+
+    The MIME tree (HTML body plus attachments) is identical for every
+    recipient, so it is built and serialized once per worker; each send only
+    prepends the recipient's To: header to the prebuilt payload instead of
+    re-encoding the body and attachments. attachment_blobs is a list of
+    (filename, mimetype, bytes). Returns (sent, failed) address lists.
+    """
+    sent = []
+    failed = []
+    smtp_user = app.config['SMTP_USERNAME']
+
+    base = MIMEMultipart("mixed")
+    base['From'] = smtp_user
+    base['Subject'] = subject
+    base.add_header('X-Mailer', 'Atlantic Diving Center CRM')
+    base.attach(MIMEText(content, "html", "utf-8"))
+    for name, mime, data in attachment_blobs:
+        try:
+            base.attach(_build_attachment(name, data, mime))
+        except Exception as attach_error:
+            logger.error(f"Error attaching file {name}: {str(attach_error)}")
+    base_payload = base.as_string()
+
+    server = None
+    try:
+        for email in emails:
+            try:
+                server = ensure_smtp_connection(server)
+                server.sendmail(smtp_user, [email], f"To: {email}\r\n{base_payload}")
+                sent.append(email)
+                logger.info(f"Marketing email sent to {email}")
+            except Exception as e:
+                failed.append(email)
+                logger.error(f"Failed to send marketing email to {email}: {str(e)}")
+    finally:
+        close_smtp_connection(server)
+    return sent, failed
+
+
+_BULK_SPLIT = re.compile(r'[\n,]+')  # pasted recipients: one per line and/or comma-separated
+_EMAIL_RE = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')  # cheap shape check, one pass per address
+
+
+def _write_marketing_emails(path, emails):
+    """Write the recipients file atomically, one address per line.
+
+    Writing to a sibling temp file and os.replace()-ing it in means a crash
+    mid-write can never leave a half-truncated marketing_emails.txt behind.
+    Resubmitting the same recipient list is a no-op: a read-and-compare is
+    far cheaper than a rewrite on a networked filesystem.
+    """
+    payload = ''.join(e + '\n' for e in emails)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            if f.read() == payload:
+                return
+    except OSError:
+        pass  # missing/unreadable file: just write it
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8', buffering=65536) as f:
+        f.write(payload)
+    os.replace(tmp, path)
+
+
 @app.route('/marketing-emails', methods=['GET', 'POST'])
 @login_required
+@admin_required
 def marketing_emails():
     """Marketing email interface for bulk sending"""
-    if not session.get('is_admin'):
-        return redirect(url_for('index'))
-
     # File to store marketing emails
     marketing_emails_file = 'marketing_emails.txt'
 
@@ -1620,47 +1964,30 @@ def marketing_emails():
                 flash('Por favor, preencha o assunto e o conteúdo do email.', 'danger')
                 return redirect(url_for('marketing_emails'))
 
-            # Save bulk emails to file
-            if bulk_emails_text.strip():
-                # Clean up the email text before saving
-                cleaned_emails = []
-                lines = bulk_emails_text.strip().split('\n')
-                for line in lines:
-                    if line.strip():
-                        # Split by commas if present
-                        if ',' in line:
-                            emails_in_line = [email.strip() for email in line.split(',') if email.strip()]
-                            cleaned_emails.extend(emails_in_line)
-                        else:
-                            cleaned_emails.append(line.strip())
+            # Parse the pasted text once: one split over newlines/commas
+            # covers both the file on disk and the recipient list, instead
+            # of running the same line loop twice. The isspace() guard skips
+            # the split without allocating a stripped copy of the textarea.
+            bulk_emails = []
+            if bulk_emails_text and not bulk_emails_text.isspace():
+                bulk_emails = [p.strip() for p in _BULK_SPLIT.split(bulk_emails_text) if p.strip()]
 
+            if bulk_emails:
                 # Save one email per line, no extra spaces
-                with open(marketing_emails_file, 'w', encoding='utf-8') as f:
-                    f.write('\n'.join(cleaned_emails))
+                _write_marketing_emails(marketing_emails_file, bulk_emails)
                 logger.info(f"Marketing emails saved to {marketing_emails_file}")
 
-            # Parse bulk emails
-            bulk_emails = []
-            if bulk_emails_text.strip():
-                # Split by newlines first, then by commas
-                lines = bulk_emails_text.strip().split('\n')
-                for line in lines:
-                    if line.strip():
-                        # Split by commas if present
-                        if ',' in line:
-                            emails_in_line = [email.strip() for email in line.split(',') if email.strip()]
-                            bulk_emails.extend(emails_in_line)
-                        else:
-                            bulk_emails.append(line.strip())
-
             # Get clients from database if requested
             database_emails = []
             if request.form.get('include_database') == 'on':
-                response = supabase.table("clientes").select("*").execute()
+                response = supabase.table("clientes").select("email").execute()
                 database_emails = [client['email'] for client in response.data]
 
-            # Combine all email addresses
-            all_emails = list(set(bulk_emails + database_emails))  # Remove duplicates
+            # Combine all email addresses. dict.fromkeys keeps first-seen
+            # order and the lower() fold stops User@x.com / user@x.com from
+            # getting the campaign twice.
+            normalized = (e.strip().lower() for e in bulk_emails + database_emails if e and e.strip())
+            all_emails = list(dict.fromkeys(normalized))
 
             if not all_emails:
                 flash('Nenhum destinatário encontrado. Adicione emails ou marque "Incluir clientes da base de dados".',
@@ -1675,23 +2002,23 @@ def marketing_emails():
                     if file and file.filename:
                         attachments.append(file)
 
-            # Send marketing email to all recipients
+            # Read each attachment once up front so workers can share the bytes
+            attachment_blobs = [(f.filename, f.mimetype, f.read()) for f in attachments]
+
+            # Fan the sends out over a worker pool; each worker keeps one
+            # persistent SMTP connection for its slice of the recipient list
             emails_sent = 0
             failed_emails = []
-
-            for email in all_emails:
-                try:
-                    # Send the email with attachments
-                    if enviar_email_personalizado_aux(email, subject, content, attachments):
-                        emails_sent += 1
-                        logger.info(f"Marketing email sent to {email}")
-                    else:
-                        failed_emails.append(email)
-                        logger.error(f"Failed to send marketing email to {email}")
-
-                except Exception as e:
-                    failed_emails.append(email)
-                    logger.error(f"Failed to send marketing email to {email}: {str(e)}")
+            if all_emails:
+                n_workers = min(8, len(all_emails))
+                chunks = [all_emails[i::n_workers] for i in range(n_workers)]
+                with ThreadPoolExecutor(max_workers=n_workers) as pool:
+                    results = pool.map(
+                        lambda chunk: _send_marketing_chunk(chunk, subject, content, attachment_blobs),
+                        chunks)
+                    for sent, failed in results:
+                        emails_sent += len(sent)
+                        failed_emails.extend(failed)
 
             # Show results
             if emails_sent > 0:
@@ -1705,33 +2032,15 @@ def marketing_emails():
             flash(f'Erro ao enviar marketing emails: {str(e)}', 'danger')
             logger.error(f"Marketing email error: {str(e)}")
 
-    # Get client count for display
-    response = supabase.table("clientes").select("*").execute()
-    client_count = len(response.data)
+    # Get client count for display - HEAD + count=exact returns just the number
+    response = supabase.table("clientes").select("email", count="exact", head=True).execute()
+    client_count = response.count or 0
 
-    # Get marketing email lists from Supabase with pagination to handle large datasets
+    # Grouped lists come from the shared short-TTL cache
     email_lists = []
     try:
-        # Fetch all records using pagination helper function
-        all_records = fetch_all_marketing_emails_paginated()
-
-        # Group emails by list name
-        lists = {}
-        for record in all_records:
-            list_name = record['list_name']
-            if list_name not in lists:
-                lists[list_name] = []
-            lists[list_name].append(record['email'])
-
-        # Convert to format for frontend
-        for list_name, emails in lists.items():
-            email_lists.append({
-                'list_name': list_name,
-                'email_count': len(emails),
-                'emails': emails
-            })
-
-        logger.info(f"Loaded {len(email_lists)} marketing email lists with {len(all_records)} total email records from Supabase")
+        email_lists = _load_email_lists()
+        logger.info(f"Loaded {len(email_lists)} marketing email lists from Supabase")
     except Exception as e:
         logger.error(f"Error loading marketing email lists: {str(e)}")
 
@@ -1741,11 +2050,9 @@ def marketing_emails():
 # ---------------Remove marketing emails-----------------
 @app.route('/clear-marketing-emails', methods=['POST'])
 @login_required
+@admin_required
 def clear_marketing_emails():
     """Clear the saved marketing emails file"""
-    if not session.get('is_admin'):
-        return redirect(url_for('index'))
-
     try:
         marketing_emails_file = 'marketing_emails.txt'
         if os.path.exists(marketing_emails_file):
@@ -1764,49 +2071,11 @@ def clear_marketing_emails():
 # --------------Get email lists----------------
 @app.route('/get-marketing-email-lists', methods=['GET'])
 @login_required
+@admin_required
 def get_marketing_email_lists():
     """Get all marketing email lists from Supabase"""
-    if not session.get('is_admin'):
-        return {'error': 'Unauthorized'}, 403
-
     try:
-        # Get all marketing email lists using pagination to handle large datasets
-        all_records = []
-        page_size = 1000
-        offset = 0
-        
-        while True:
-            response = supabase.table("marketing_email_lists").select("*").range(offset, offset + page_size - 1).execute()
-            
-            if not response.data:
-                break
-                
-            all_records.extend(response.data)
-            
-            # If we got less than page_size records, we've reached the end
-            if len(response.data) < page_size:
-                break
-                
-            offset += page_size
-
-        # Group emails by list name
-        lists = {}
-        for record in all_records:
-            list_name = record['list_name']
-            if list_name not in lists:
-                lists[list_name] = []
-            lists[list_name].append(record['email'])
-
-        # Convert to format for frontend
-        email_lists = []
-        for list_name, emails in lists.items():
-            email_lists.append({
-                'list_name': list_name,
-                'email_count': len(emails),
-                'emails': emails
-            })
-
-        return {'lists': email_lists}
+        return {'lists': _load_email_lists()}
 
     except Exception as e:
         logger.error(f"Error getting marketing email lists: {str(e)}")
@@ -1816,11 +2085,9 @@ def get_marketing_email_lists():
 # --------------Delete emails from marketing lists--------------
 @app.route('/delete-marketing-email-list', methods=['POST'])
 @login_required
+@admin_required
 def delete_marketing_email_list():
     """Delete a marketing email list from Supabase"""
-    if not session.get('is_admin'):
-        return {'error': 'Unauthorized'}, 403
-
     try:
         list_name = request.form.get('list_name', '')
         if not list_name:
@@ -1828,6 +2095,7 @@ def delete_marketing_email_list():
 
         # Delete the list
         supabase.table("marketing_email_lists").delete().eq("list_name", list_name).execute()
+        _invalidate_email_lists_cache()
 
         logger.info(f"Deleted marketing email list: {list_name}")
         return {'success': True, 'message': f'Lista "{list_name}" removida com sucesso'}
@@ -1840,50 +2108,15 @@ def delete_marketing_email_list():
 # -------------Editing marketing email lists----------------
 @app.route('/marketing-email-editor', methods=['GET'])
 @login_required
+@admin_required
 def marketing_email_editor():
     """Web-based Excel editor for marketing email lists"""
-    if not session.get('is_admin'):
-        return redirect(url_for('index'))
 
-    # Get all existing lists using pagination
+    # Grouped lists come from the shared short-TTL cache
     email_lists = []
     try:
-        # Fetch all records using pagination to overcome Supabase's 1000 row default limit
-        all_records = []
-        page_size = 1000
-        offset = 0
-        
-        while True:
-            lists_response = supabase.table("marketing_email_lists").select("*").range(offset, offset + page_size - 1).execute()
-            
-            if not lists_response.data:
-                break
-                
-            all_records.extend(lists_response.data)
-            
-            # If we got less than page_size records, we've reached the end
-            if len(lists_response.data) < page_size:
-                break
-                
-            offset += page_size
-
-        # Group emails by list name
-        lists = {}
-        for record in all_records:
-            list_name = record['list_name']
-            if list_name not in lists:
-                lists[list_name] = []
-            lists[list_name].append(record['email'])
-
-        # Convert to format for frontend
-        for list_name, emails in lists.items():
-            email_lists.append({
-                'list_name': list_name,
-                'email_count': len(emails),
-                'emails': emails
-            })
-
-        logger.info(f"Loaded {len(email_lists)} marketing email lists with {len(all_records)} total email records for editor")
+        email_lists = _load_email_lists()
+        logger.info(f"Loaded {len(email_lists)} marketing email lists for editor")
     except Exception as e:
         logger.error(f"Error loading marketing email lists for editor: {str(e)}")
 
@@ -1893,49 +2126,11 @@ def marketing_email_editor():
 # ---------Storing email lists----------
 @app.route('/api/marketing-lists', methods=['GET'])
 @login_required
+@admin_required
 def get_marketing_lists_api():
     """API endpoint to get all marketing lists"""
-    if not session.get('is_admin'):
-        return {'error': 'Unauthorized'}, 403
-
     try:
-        # Fetch all records using pagination to overcome Supabase's 1000 row default limit
-        all_records = []
-        page_size = 1000
-        offset = 0
-        
-        while True:
-            response = supabase.table("marketing_email_lists").select("*").range(offset, offset + page_size - 1).execute()
-            
-            if not response.data:
-                break
-                
-            all_records.extend(response.data)
-            
-            # If we got less than page_size records, we've reached the end
-            if len(response.data) < page_size:
-                break
-                
-            offset += page_size
-
-        # Group emails by list name
-        lists = {}
-        for record in all_records:
-            list_name = record['list_name']
-            if list_name not in lists:
-                lists[list_name] = []
-            lists[list_name].append(record['email'])
-
-        # Convert to format for frontend
-        email_lists = []
-        for list_name, emails in lists.items():
-            email_lists.append({
-                'list_name': list_name,
-                'email_count': len(emails),
-                'emails': emails
-            })
-
-        return {'lists': email_lists}
+        return {'lists': _load_email_lists()}
 
     except Exception as e:
         logger.error(f"Error getting marketing lists API: {str(e)}")
@@ -1944,11 +2139,9 @@ def get_marketing_lists_api():
 
 @app.route('/api/marketing-list/<list_name>', methods=['GET'])
 @login_required
+@admin_required
 def get_marketing_list_api(list_name):
     """API endpoint to get a specific marketing list"""
-    if not session.get('is_admin'):
-        return {'error': 'Unauthorized'}, 403
-
     try:
         # Get specific marketing list using pagination to handle large lists
         all_records = []
@@ -1998,11 +2191,9 @@ def get_marketing_list_api(list_name):
 
 @app.route('/api/marketing-list', methods=['POST'])
 @login_required
+@admin_required
 def save_marketing_list_api():
     """API endpoint to save/update a marketing list"""
-    if not session.get('is_admin'):
-        return {'error': 'Unauthorized'}, 403
-
     try:
         data = request.get_json()
         list_name = data.get('list_name', '').strip()
@@ -2023,7 +2214,7 @@ def save_marketing_list_api():
                 name = ''
                 phone = ''
 
-            if raw_email and '@' in raw_email and '.' in raw_email.split('@')[-1]:
+            if raw_email and _EMAIL_RE.match(raw_email):
                 normalized_entries.append({'email': raw_email, 'name': name, 'phone': phone})
 
         # Remove duplicates
@@ -2039,7 +2230,10 @@ def save_marketing_list_api():
         # Delete existing list
         supabase.table("marketing_email_lists").delete().eq("list_name", list_name).execute()
 
-        # Insert new emails (with optional name/phone when supported)
+        # Insert new emails (with optional name/phone when supported).
+        # One timestamp for the whole batch: the rows are created in the
+        # same request, and per-row now() calls are pure allocation churn.
+        created_at = datetime.now().isoformat()
         if unique_entries:
             try:
                 email_records = []
@@ -2049,28 +2243,33 @@ def save_marketing_list_api():
                         'email': entry['email'],
                         'name': entry.get('name') or None,
                         'phone': entry.get('phone') or None,
-                        'created_at': datetime.now().isoformat()
+                        'created_at': created_at
                     })
-                supabase.table("marketing_email_lists").insert(email_records).execute()
+                for chunk in _chunked(email_records):
+                    supabase.table("marketing_email_lists").insert(chunk).execute()
             except Exception as insert_err:
                 # Fallback for schemas without name/phone columns
                 logger.warning(f"Insert with name/phone failed, falling back to email only: {insert_err}")
+                # Re-delete so chunks that landed before the failure are not duplicated
+                supabase.table("marketing_email_lists").delete().eq("list_name", list_name).execute()
                 email_records = []
                 for entry in unique_entries:
                     email_records.append({
                         'list_name': list_name,
                         'email': entry['email'],
-                        'created_at': datetime.now().isoformat()
+                        'created_at': created_at
                     })
-                supabase.table("marketing_email_lists").insert(email_records).execute()
+                for chunk in _chunked(email_records):
+                    supabase.table("marketing_email_lists").insert(chunk).execute()
         else:
             # Insert a placeholder record for the list with no emails
             supabase.table("marketing_email_lists").insert([{
                 'list_name': list_name,
                 'email': None,
-                'created_at': datetime.now().isoformat()
+                'created_at': created_at
             }]).execute()
 
+        _invalidate_email_lists_cache()
         logger.info(f"Saved marketing list '{list_name}' with {len(unique_entries)} emails")
         return {
             'success': True,
@@ -2086,13 +2285,12 @@ def save_marketing_list_api():
 
 @app.route('/api/marketing-list/<list_name>', methods=['DELETE'])
 @login_required
+@admin_required
 def delete_marketing_list_api(list_name):
     """API endpoint to delete a marketing list"""
-    if not session.get('is_admin'):
-        return {'error': 'Unauthorized'}, 403
-
     try:
         supabase.table("marketing_email_lists").delete().eq("list_name", list_name).execute()
+        _invalidate_email_lists_cache()
 
         logger.info(f"Deleted marketing list: {list_name}")
         return {
@@ -2141,28 +2339,33 @@ def upload_marketing_emails_excel():
             logger.error("No list name specified")
             return jsonify({'error': 'List name not specified'}), 400
 
-        # Read Excel file from specific sheet
+        # Stream the sheet with openpyxl read_only instead of materializing
+        # every column in a DataFrame: only the email column is kept
         try:
-            if sheet_name:
-                logger.info(f"Reading Excel file with sheet: {sheet_name}")
-                df = pd.read_excel(file, sheet_name=sheet_name)
-            else:
-                logger.info("Reading Excel file (default sheet)")
-                df = pd.read_excel(file)  # Default to first sheet
-                
-            logger.info(f"Excel file read successfully. Shape: {df.shape}, Columns: {list(df.columns)}")
+            logger.info(f"Reading Excel file (sheet: {sheet_name or 'default'})")
+            workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+            worksheet = workbook[sheet_name] if sheet_name else workbook.active
+        except KeyError:
+            logger.error(f"Sheet '{sheet_name}' not found in Excel file")
+            return jsonify({'error': f'Sheet "{sheet_name}" not found in the Excel file'}), 400
         except Exception as e:
             logger.error(f"Error reading Excel file: {e}")
             return jsonify({'error': f'Error reading Excel file: {str(e)}'}), 400
 
-        # Check if email column exists
-        if email_column not in df.columns:
-            logger.error(f"Column '{email_column}' not found in Excel file. Available columns: {list(df.columns)}")
+        # First row = headers; check if email column exists
+        rows = worksheet.iter_rows(values_only=True)
+        headers = [str(h) if h is not None else '' for h in next(rows, ())]
+        if email_column not in headers:
+            workbook.close()
+            logger.error(f"Column '{email_column}' not found in Excel file. Available columns: {headers}")
             return jsonify({'error': f'Column "{email_column}" not found in the Excel file'}), 400
+        col_idx = headers.index(email_column)
 
-        # Extract emails from specified column
+        # Extract emails from specified column (read_only rows can be ragged)
         try:
-            emails = df[email_column].dropna().astype(str).tolist()
+            emails = [row[col_idx] for row in rows
+                      if len(row) > col_idx and row[col_idx] is not None]
+            workbook.close()
             logger.info(f"Extracted {len(emails)} emails from column '{email_column}'")
         except Exception as e:
             logger.error(f"Error extracting emails from column '{email_column}': {e}")
@@ -2174,57 +2377,31 @@ def upload_marketing_emails_excel():
         empty_entries = 0
         
         logger.info(f"Starting email validation for {len(emails)} entries")
-        
-        for i, email in enumerate(emails):
-            email_str = str(email).strip()
-            original_email = email_str  # Keep original for logging
-            email_str = email_str.lower()
-            
-            # Log first few entries for debugging
-            if i < 5:
-                logger.info(f"Processing email {i+1}: '{original_email}' -> '{email_str}'")
-            
-            # Skip empty or NaN values
-            if email_str in ['', 'nan', 'none', 'null'] or pd.isna(email):
+
+        for email in emails:
+            original_email = str(email).strip()
+            email_str = original_email.lower()
+
+            # Skip empty or NaN-ish values
+            if email_str in ('', 'nan', 'none', 'null'):
                 empty_entries += 1
                 continue
-                
-            # Basic email validation - very lenient
-            if '@' in email_str and '.' in email_str and len(email_str) > 5:
-                # Try multiple validation approaches
-                import re
-                
-                # Very lenient pattern - just check basic structure
-                basic_pattern = r'^[^@\s]+@[^@\s]+\.[^@\s]+$'
-                # More strict pattern
-                strict_pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-                
-                if re.match(basic_pattern, email_str):
-                    valid_emails.append(email_str)
-                    if len(valid_emails) <= 3:  # Log first few valid emails
-                        logger.info(f"Valid email found (basic pattern): '{email_str}'")
-                elif re.match(strict_pattern, email_str):
-                    valid_emails.append(email_str)
-                    if len(valid_emails) <= 3:  # Log first few valid emails
-                        logger.info(f"Valid email found (strict pattern): '{email_str}'")
-                else:
-                    # Even more lenient - just check if it looks like an email
-                    parts = email_str.split('@')
-                    if len(parts) == 2 and '.' in parts[1] and len(parts[0]) > 0 and len(parts[1]) > 2:
-                        valid_emails.append(email_str)
-                        if len(valid_emails) <= 3:  # Log first few valid emails
-                            logger.info(f"Valid email found (manual check): '{email_str}'")
-                    else:
-                        invalid_emails.append(original_email)
-                        if len(invalid_emails) <= 3:  # Log first few invalid emails
-                            logger.info(f"Invalid email (all patterns failed): '{original_email}'")
+
+            # One anchored precompiled pattern replaces the old cascade of
+            # per-row re.match calls against three literal patterns
+            if _EMAIL_RE.match(email_str):
+                valid_emails.append(email_str)
             else:
                 invalid_emails.append(original_email)
                 if len(invalid_emails) <= 3:  # Log first few invalid emails
-                    logger.info(f"Invalid email (basic check failed): '{original_email}'")
+                    logger.info(f"Invalid email: '{original_email}'")
+
+        # Collapse duplicates inside the file itself (order-preserving) so
+        # they are not counted or inserted twice further down
+        valid_emails = list(dict.fromkeys(valid_emails))
 
         logger.info(f"Email validation results - Valid: {len(valid_emails)}, Invalid: {len(invalid_emails)}, Empty: {empty_entries}")
-        
+
         if not valid_emails:
             error_msg = f'No valid emails found in the selected column "{email_column}". '
             error_msg += f'Found {len(invalid_emails)} invalid entries and {empty_entries} empty entries.'
@@ -2240,60 +2417,33 @@ def upload_marketing_emails_excel():
             # Delete existing emails for this list first
             try:
                 delete_result = supabase.table('marketing_email_lists').delete().eq('list_name', list_name).execute()
+                _invalidate_email_lists_cache()
                 logger.info(f"Deleted existing list: {list_name}, affected rows: {len(delete_result.data) if delete_result.data else 0}")
             except Exception as e:
                 logger.warning(f"Could not delete existing list (may not exist): {e}")
-        else:
-            # Check for existing emails to avoid duplicates using pagination
-            try:
-                existing_email_set = set()
-                page_size = 1000
-                offset = 0
-                
-                while True:
-                    existing_emails = supabase.table('marketing_email_lists').select('email').eq('list_name', list_name).range(offset, offset + page_size - 1).execute()
-                    
-                    if not existing_emails.data:
-                        break
-                        
-                    for record in existing_emails.data:
-                        if record['email']:
-                            existing_email_set.add(record['email'])
-                    
-                    # If we got less than page_size records, we've reached the end
-                    if len(existing_emails.data) < page_size:
-                        break
-                        
-                    offset += page_size
-                
-                # Filter out emails that already exist
-                valid_emails = [email for email in valid_emails if email not in existing_email_set]
-                logger.info(f"Filtered out {len(existing_email_set)} existing emails from list: {list_name}")
-            except Exception as e:
-                logger.warning(f"Could not check existing emails: {e}")
-
-        # Insert emails one by one, handling duplicates
+        # One round-trip: the (list_name, email) unique index filters
+        # duplicates server-side (migrations/marketing_email_lists_unique.sql),
+        # replacing the old paginated existing-email fetch plus row-by-row
+        # inserts. PostgREST only returns the rows it actually inserted.
         successful_inserts = 0
-        duplicate_count = 0
         error_count = 0
+        email_records = [{
+            'list_name': list_name,
+            'email': email,
+            'created_at': 'now()'
+        } for email in valid_emails]
 
-        for email in valid_emails:
+        for chunk in _chunked(email_records):
             try:
-                result = supabase.table('marketing_email_lists').insert({
-                    'list_name': list_name,
-                    'email': email,
-                    'created_at': 'now()'
-                }).execute()
-                successful_inserts += 1
-
+                result = supabase.table('marketing_email_lists').upsert(
+                    chunk, on_conflict='list_name,email', ignore_duplicates=True
+                ).execute()
+                successful_inserts += len(result.data) if result.data else 0
             except Exception as e:
-                error_str = str(e).lower()
-                if 'duplicate key' in error_str or 'unique constraint' in error_str:
-                    duplicate_count += 1
-                    logger.info(f"Duplicate email skipped: {email}")
-                else:
-                    error_count += 1
-                    logger.error(f"Error inserting email {email}: {e}")
+                error_count += len(chunk)
+                logger.error(f"Error inserting emails for list {list_name}: {e}")
+
+        duplicate_count = len(valid_emails) - successful_inserts - error_count
 
         # Prepare response message
         message_parts = []
@@ -2304,6 +2454,8 @@ def upload_marketing_emails_excel():
         if error_count > 0:
             message_parts.append(f"{error_count} erros encontrados")
 
+        if successful_inserts:
+            _invalidate_email_lists_cache()
         logger.info(f"Upload completed - Success: {successful_inserts}, Duplicates: {duplicate_count}, Errors: {error_count}")
         
         if successful_inserts == 0 and duplicate_count == 0:
@@ -2482,21 +2634,23 @@ def generate_test_excel():
 
 
 @app.route('/marcar-email-manual/<email>', methods=['POST'])
+@login_required
 def marcar_email_manual(email):
-    resultado = supabase.table("clientes").select("*").eq("email", email).execute()
-    dados = resultado.data
-
-    if not dados:
-        flash("Cliente não encontrado.", "danger")
-        return redirect(url_for("index"))
-
-    cliente = dados[0]
-
-    if not cliente["email_manual_enviado"]:
-        supabase.table("clientes").update({"email_manual_enviado": True}).eq("email", email).execute()
+    # One conditional UPDATE instead of select-then-update: the flag guard
+    # makes the common path a single round-trip, and the existence probe
+    # only runs when nothing was updated to tell "not found" from "already sent"
+    resultado = supabase.table("clientes").update({"email_manual_enviado": True}) \
+        .eq("email", email).eq("email_manual_enviado", False).execute()
+
+    if resultado.data:
+        _invalidate_clientes_cache()
         flash("Email marcado como enviado com sucesso.", "success")
     else:
-        flash("O email já estava marcado como enviado.", "info")
+        existe = supabase.table("clientes").select("email").eq("email", email).limit(1).execute()
+        if existe.data:
+            flash("O email já estava marcado como enviado.", "info")
+        else:
+            flash("Cliente não encontrado.", "danger")
 
     return redirect(url_for("index"))
 
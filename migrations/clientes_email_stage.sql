@@ -0,0 +1,48 @@
+-- Optional consolidation of the scheduler email flags into a single stage
+-- column (0 = none sent, 1 = first sent, 2 = second sent). Run once against
+-- the Supabase project.
+--
+-- email_manual_enviado stays a separate boolean: it is toggled by the manual
+-- send routes independently of the first/second scheduler emails, so it does
+-- not fit a monotonic stage. The trigger keeps email_stage in sync with the
+-- existing flags so the application keeps working unchanged while queries
+-- and indexes can use the single `email_stage < 2` predicate.
+
+ALTER TABLE clientes
+    ADD COLUMN IF NOT EXISTS email_stage smallint NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS last_email_sent_at timestamptz;
+
+UPDATE clientes
+SET email_stage = CASE
+        WHEN segundo_email_enviado THEN 2
+        WHEN primeiro_email_enviado THEN 1
+        ELSE 0
+    END,
+    last_email_sent_at = COALESCE(segundo_email_enviado_em::timestamptz,
+                                  primeiro_email_enviado_em::timestamptz);
+
+CREATE OR REPLACE FUNCTION clientes_sync_email_stage() RETURNS trigger AS $$
+BEGIN
+    NEW.email_stage := CASE
+        WHEN NEW.segundo_email_enviado THEN 2
+        WHEN NEW.primeiro_email_enviado THEN 1
+        ELSE 0
+    END;
+    NEW.last_email_sent_at := COALESCE(NEW.segundo_email_enviado_em::timestamptz,
+                                       NEW.primeiro_email_enviado_em::timestamptz,
+                                       NEW.last_email_sent_at);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS clientes_sync_email_stage_trg ON clientes;
+CREATE TRIGGER clientes_sync_email_stage_trg
+    BEFORE INSERT OR UPDATE OF primeiro_email_enviado, segundo_email_enviado
+    ON clientes
+    FOR EACH ROW
+    EXECUTE FUNCTION clientes_sync_email_stage();
+
+-- One predicate to index instead of two boolean columns
+CREATE INDEX IF NOT EXISTS clientes_email_stage_pending
+    ON clientes (data_mergulho)
+    WHERE email_stage < 2;
@@ -0,0 +1,9 @@
+-- Unique index backing the upsert in the index() registration flow.
+-- Run once against the Supabase project (SQL editor or psql).
+--
+-- With this in place the app registers clients with a single
+-- upsert(on_conflict="email", ignore_duplicates=True) instead of a
+-- select + insert pair, closing the race window between the two.
+
+CREATE UNIQUE INDEX IF NOT EXISTS clientes_email_unique
+    ON clientes (email);
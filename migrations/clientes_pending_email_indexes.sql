@@ -0,0 +1,14 @@
+-- Partial indexes backing the scheduler query in check_and_send_emails.
+-- Run once against the Supabase project (SQL editor or psql).
+--
+-- The scheduler only asks for rows with an unsent flag and a dive date at
+-- least one day old; these partial indexes keep that scan O(log N) and
+-- shrink as emails get sent.
+
+CREATE INDEX IF NOT EXISTS clientes_pending_first
+    ON clientes (data_mergulho)
+    WHERE primeiro_email_enviado = false;
+
+CREATE INDEX IF NOT EXISTS clientes_pending_second
+    ON clientes (data_mergulho)
+    WHERE segundo_email_enviado = false;
@@ -0,0 +1,11 @@
+-- Unique index backing the upsert in upload_marketing_emails_excel.
+-- Run once against the Supabase project (SQL editor or psql).
+--
+-- With this in place the Excel upload sends one upsert with
+-- on_conflict="list_name,email" and ignore_duplicates=True instead of
+-- paginating the existing list into Python and inserting row by row.
+-- Placeholder rows for empty lists keep email NULL; NULLs compare
+-- distinct, so they never collide with each other.
+
+CREATE UNIQUE INDEX IF NOT EXISTS marketing_email_lists_list_email_unique
+    ON marketing_email_lists (list_name, email);
@@ -0,0 +1,38 @@
+-- Optional parent table for marketing lists so an empty list no longer
+-- needs an email=NULL placeholder row. Run once against the Supabase
+-- project (SQL editor or psql).
+--
+-- The application keeps reading and writing marketing_email_lists
+-- unchanged: the trigger below inserts the parent row for every list the
+-- app touches, so deployments can apply this at their own pace. Once it
+-- is applied everywhere, the placeholder insert in save_marketing_list_api
+-- can be dropped and the NULL rows cleaned up (see the end of this file).
+
+CREATE TABLE IF NOT EXISTS marketing_lists (
+    list_name text PRIMARY KEY,
+    created_at timestamptz NOT NULL DEFAULT now()
+);
+
+-- Backfill from the lists that already exist
+INSERT INTO marketing_lists (list_name)
+SELECT DISTINCT list_name FROM marketing_email_lists
+ON CONFLICT (list_name) DO NOTHING;
+
+-- Keep the parent table in sync while the app still writes the old shape
+CREATE OR REPLACE FUNCTION marketing_email_lists_sync_parent() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO marketing_lists (list_name) VALUES (NEW.list_name)
+    ON CONFLICT (list_name) DO NOTHING;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS marketing_email_lists_sync_parent_trg ON marketing_email_lists;
+CREATE TRIGGER marketing_email_lists_sync_parent_trg
+    BEFORE INSERT ON marketing_email_lists
+    FOR EACH ROW
+    EXECUTE FUNCTION marketing_email_lists_sync_parent();
+
+-- After every deployment runs this migration, the app can stop inserting
+-- placeholder rows and the sentinels can go:
+--     DELETE FROM marketing_email_lists WHERE email IS NULL;
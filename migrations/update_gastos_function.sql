@@ -0,0 +1,15 @@
+-- One-round-trip gastos update backing the /update-gastos route.
+-- Run once against the Supabase project (SQL editor or psql).
+--
+-- The route used to SELECT valor_fatura and then UPDATE gastos/receita in
+-- a second request; this function does both in one statement where the row
+-- lives and returns the new receita (NULL when the email does not exist).
+
+CREATE OR REPLACE FUNCTION update_gastos(p_email text, p_gastos numeric)
+RETURNS numeric AS $$
+    UPDATE clientes
+    SET gastos = p_gastos,
+        receita = valor_fatura - p_gastos
+    WHERE email = p_email
+    RETURNING receita;
+$$ LANGUAGE sql;